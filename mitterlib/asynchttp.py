@@ -0,0 +1,795 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Mitter, a client for Twitter.
+# Copyright (C) 2007, 2008 The Mitter Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# An alternative to the ThreadHTTP workers: instead of one thread per
+# request, a single thread runs an event loop (based on select()) with all the
+# requests in flight. It reads the requests from the same RequestScheduler and
+# calls the callbacks exactly like ThreadHTTP does, so the Twitter object
+# doesn't really care which one it is using.
+
+import socket
+import select
+import urlparse
+import errno
+import ssl
+import time
+import zlib
+import logging
+import threading
+import Queue
+
+from threadhttp import ThreadHTTP, Decoder, JSONStream
+
+
+# errno values which mean "try again later" for non-blocking sockets
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS,
+        errno.EALREADY)
+
+
+class ProtocolError(Exception):
+    """The server sent something we can't understand."""
+    pass
+
+
+class AsyncResponse(object):
+    """The response of a request made by the AsyncHTTP engine. It mimics the
+    bits of httplib.HTTPResponse used by ThreadHTTP."""
+
+    def __init__(self, version, status, headers):
+        self.version = version
+        self.status = status
+        self._headers = headers
+
+        self.data = None
+        self.size = 0
+        self.compressed_size = 0
+        self.stream = None
+
+    def getheader(self, name, default=None):
+        """Return the value of the header <name>."""
+        return self._headers.get(name.lower(), default)
+
+
+class _Transfer(object):
+    """A request being processed by the event loop."""
+
+    # states
+    (RESOLVING, CONNECTING, HANDSHAKE, SENDING, HEAD, BODY, DONE) = range(7)
+
+    def __init__(self, request, headers, cached):
+        self.request = request
+        self.url = request.url
+        self.headers = headers
+        self.body = request.body
+        self.cached = cached
+        self.redirects = 0
+
+        self.sock = None
+        self.key = None
+        self.addresses = []     # the addresses not tried yet
+        self.reused = False
+        self.state = None
+        self.handshake_write = False
+        self.received = 0
+        self.last_activity = time.time()
+
+    def wants_write(self):
+        """True if we are waiting the socket to be writable."""
+        return self.state in (self.CONNECTING, self.SENDING) or \
+                (self.state == self.HANDSHAKE and self.handshake_write)
+
+
+class AsyncHTTP(ThreadHTTP):
+    """Runs all the HTTP requests in a single thread, using non-blocking
+    sockets. At most <concurrency> requests are in flight at the same time;
+    the others wait in the queue."""
+
+    # how long (in seconds) we wait for the socket to be ready when there are
+    # requests in flight, before checking the queue for new requests again
+    POLL_INTERVAL = 0.05
+
+    # how long (in seconds) the addresses of a host are kept (and how long
+    # we remember a host couldn't be found)
+    DNS_TTL = 300
+    DNS_ERROR_TTL = 10
+
+    # how long (in seconds) we wait for a connection before trying the next
+    # address of the host, if there is one
+    CONNECT_TIMEOUT = 5
+
+    def __init__(self, id, shared_queue=None, cache=None, inflight=None,
+            retry=None, breaker=None, concurrency=16, timeout=30,
+            idle_timeout=60):
+        ThreadHTTP.__init__(self, id, shared_queue, None, cache, inflight,
+                retry, breaker)
+        self._log = logging.getLogger('mitterlib.asynchttp.%d' % (id))
+
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+
+        self._active = []
+        self._idle = {}         # (scheme, host, port) -> [(last used, sock)]
+        self._addresses = {}    # (host, port) -> (expires, addresses, error)
+        self._resolving = set()     # (host, port) being looked up
+        self._ssl_context = None
+
+        self.opened = 0
+        self.reused = 0
+        self.peak = 0
+
+    # ------------------------------------------------------------
+    # Event loop
+    # ------------------------------------------------------------
+
+    def run(self):
+        """Process the requests in the queue, until we get a None."""
+        stopping = False
+        while True:
+            while len(self._active) < self.concurrency:
+                if stopping and not self.queue.pending():
+                    break
+
+                try:
+                    # if there is nothing running, there is no reason to not
+                    # block
+                    request = self.queue.get(block=not self._active)
+                except Queue.Empty:
+                    break
+
+                if request is None:
+                    # requests still running may be retried, so we keep
+                    # going until there is nothing left
+                    self._log.debug('Engine %d stopping' % (self._id))
+                    stopping = True
+                    continue
+
+                self._start(request)
+
+            if not self._active:
+                if stopping and not self.queue.pending():
+                    break
+                continue
+
+            self.peak = max(self.peak, len(self._active))
+            self._poll()
+
+        self._log.debug('Engine %d done: %s' % (self._id, self.stats()))
+        return
+
+    def _poll(self):
+        """Wait for the sockets to be ready and process them."""
+        for transfer in self._active[:]:
+            if not self.inflight.wanted(transfer.request):
+                self._cancel(transfer)
+
+        readers = []
+        writers = []
+        for transfer in self._active:
+            if not transfer.sock:
+                # still looking up the host
+                continue
+            if transfer.wants_write():
+                writers.append(transfer.sock)
+            else:
+                readers.append(transfer.sock)
+
+        if readers or writers:
+            try:
+                (readable, writable, _) = select.select(readers, writers, [],
+                        self.POLL_INTERVAL)
+            except select.error, exc:
+                if exc.args[0] == errno.EINTR:
+                    return
+                raise
+        else:
+            (readable, writable) = ([], [])
+            time.sleep(self.POLL_INTERVAL)
+
+        ready = set(readable) | set(writable)
+        now = time.time()
+        for transfer in self._active[:]:
+            if transfer.sock in ready or self._pending(transfer):
+                transfer.last_activity = now
+                self._step(transfer)
+            elif now - transfer.last_activity > self.timeout:
+                self._log.error('Timeout requesting %s' % (transfer.url))
+                self._fail(transfer, self.LOW_LEVEL_ERROR)
+            elif transfer.state == transfer.RESOLVING:
+                self._resolve(transfer)
+            elif transfer.state == transfer.CONNECTING and \
+                    transfer.addresses and \
+                    now - transfer.last_activity > self.CONNECT_TIMEOUT:
+                self._log.debug('Timeout connecting to %s, trying the next '
+                        'address' % (transfer.host))
+                self._release(transfer, False)
+                self._connect(transfer)
+        return
+
+    def _pending(self, transfer):
+        """SSL sockets may have data already decrypted, which select() can't
+        see."""
+        return transfer.state in (transfer.HEAD, transfer.BODY) and \
+                isinstance(transfer.sock, ssl.SSLSocket) and \
+                transfer.sock.pending()
+
+    def stats(self):
+        """Return the engine counters."""
+        return {
+                'opened': self.opened,
+                'reused': self.reused,
+                'active': len(self._active),
+                'peak': self.peak}
+
+    # ------------------------------------------------------------
+    # Connection handling
+    # ------------------------------------------------------------
+
+    def _start(self, request):
+        """Start processing a request from the queue."""
+        if not self._allowed(request):
+            return
+
+        request.started()
+        (headers, cached) = self._prepare(request)
+        transfer = _Transfer(request, self._request_headers(headers,
+            request.body), cached)
+        self._active.append(transfer)
+        self._open(transfer)
+        return
+
+    def _open(self, transfer):
+        """Get a connection (reusing an idle one, if possible) and start
+        sending the request."""
+        (scheme, host, port, path) = self._split(transfer.url)
+        if port is None:
+            if scheme == 'https':
+                port = 443
+            else:
+                port = 80
+        transfer.key = (scheme, host, port)
+        transfer.path = path
+        transfer.host = host
+        if port in (80, 443):
+            transfer.host_header = host
+        else:
+            transfer.host_header = '%s:%d' % (host, port)
+
+        self._log.debug('Starting request of %s' % (transfer.url))
+        sock = self._idle_socket(transfer.key)
+        if sock:
+            self.reused += 1
+            transfer.sock = sock
+            transfer.reused = True
+            self._send_request(transfer)
+            return
+
+        transfer.state = transfer.RESOLVING
+        self._resolve(transfer)
+        return
+
+    def _resolve(self, transfer):
+        """Connect <transfer> once we have the addresses of its host. The
+        lookup runs in another thread, so a slow DNS server doesn't stop the
+        requests already running; until it's done, the loop calls this again
+        on every pass."""
+        (_, host, port) = transfer.key
+        key = (host, port)
+        entry = self._addresses.get(key)
+        if entry is None or entry[0] < time.time():
+            if key not in self._resolving:
+                self._resolving.add(key)
+                lookup = threading.Thread(target=self._lookup, args=(key,))
+                lookup.setDaemon(True)
+                lookup.start()
+            return
+
+        (_, addresses, exc) = entry
+        if exc:
+            self._log.error('DNS error: %s' % (exc))
+            self._fail(transfer, self.DNS_ERROR)
+            return
+
+        transfer.addresses = list(addresses)
+        self._connect(transfer)
+        return
+
+    def _lookup(self, key):
+        """Find the addresses of <key> (a (host, port) tuple.) Runs in its
+        own thread."""
+        (host, port) = key
+        try:
+            addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            entry = (time.time() + self.DNS_TTL, addresses, None)
+        except socket.error, exc:
+            entry = (time.time() + self.DNS_ERROR_TTL, None, exc)
+
+        # the loop only looks at the entry, so it must be there before the
+        # host stops being "resolving"
+        self._addresses[key] = entry
+        self._resolving.discard(key)
+        return
+
+    def _connect(self, transfer):
+        """Start connecting to the next address of the host of <transfer>.
+        Addresses which fail right away are skipped."""
+        problem = None
+        while transfer.addresses:
+            (family, socktype, proto, _, address) = \
+                    transfer.addresses.pop(0)
+            try:
+                sock = socket.socket(family, socktype, proto)
+            except socket.error, exc:
+                # no support for this family (IPv6, probably)
+                problem = exc
+                continue
+
+            sock.setblocking(0)
+            result = sock.connect_ex(address)
+            if result and result not in _WOULD_BLOCK:
+                problem = errno.errorcode.get(result, result)
+                sock.close()
+                continue
+
+            self.opened += 1
+            transfer.sock = sock
+            transfer.reused = False
+            transfer.state = transfer.CONNECTING
+            transfer.last_activity = time.time()
+            return
+
+        self._log.error('Socket connection error: %s' % (problem))
+        self._fail(transfer, self.LOW_LEVEL_ERROR)
+        return
+
+    def _idle_socket(self, key):
+        """Return an idle connection to <key>, if there is one still
+        usable."""
+        idle = self._idle.get(key, [])
+        now = time.time()
+        while idle:
+            (last_used, sock) = idle.pop()
+            if now - last_used > self.idle_timeout:
+                sock.close()
+                continue
+
+            # an idle socket shouldn't have anything to read; if it has, the
+            # server closed it.
+            (readable, _, _) = select.select([sock], [], [], 0)
+            if readable:
+                sock.close()
+                continue
+            return sock
+        return None
+
+    def _release(self, transfer, keep_alive):
+        """Done with the connection of <transfer>."""
+        sock = transfer.sock
+        transfer.sock = None
+        if not sock:
+            return
+
+        if keep_alive:
+            self._idle.setdefault(transfer.key, []).append((time.time(),
+                sock))
+        else:
+            try:
+                sock.close()
+            except socket.error:
+                pass
+        return
+
+    def close_connections(self):
+        """Close all the idle connections."""
+        for idle in self._idle.itervalues():
+            for (_, sock) in idle:
+                sock.close()
+        self._idle = {}
+        return
+
+    # ------------------------------------------------------------
+    # Transfer processing
+    # ------------------------------------------------------------
+
+    def _step(self, transfer):
+        """The socket of <transfer> is ready; do whatever is next."""
+        try:
+            if transfer.state == transfer.CONNECTING:
+                self._connected(transfer)
+            elif transfer.state == transfer.HANDSHAKE:
+                self._handshake(transfer)
+            elif transfer.state == transfer.SENDING:
+                self._write(transfer)
+            else:
+                self._read(transfer)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            # SSL renegotiation in the middle of the request; try again
+            pass
+        except socket.error, exc:
+            if exc.args and exc.args[0] in _WOULD_BLOCK:
+                return
+            if transfer.reused and not transfer.body and \
+                    (transfer.state == transfer.SENDING or
+                        (transfer.state == transfer.HEAD and
+                            not transfer.received)):
+                self._retry(transfer)
+                return
+            self._log.error('Socket connection error: %s' % (exc))
+            self._fail(transfer, self.LOW_LEVEL_ERROR)
+        except zlib.error, exc:
+            self._log.error('Invalid compressed data: %s' % (exc))
+            self._fail(transfer, self.INVALID_RESPONSE)
+        except ProtocolError, exc:
+            self._log.error('Invalid response: %s' % (exc))
+            self._fail(transfer, self.INVALID_RESPONSE)
+        return
+
+    def _retry(self, transfer):
+        """The (reused) connection was closed by the server before we got
+        any response; try again with a new one. Only for GETs: a POST may
+        have been applied already."""
+        self._log.debug('Stale connection, trying again')
+        self._release(transfer, False)
+        transfer.reused = False
+        self._open(transfer)
+        return
+
+    def _connected(self, transfer):
+        """The socket finished connecting."""
+        result = transfer.sock.getsockopt(socket.SOL_SOCKET,
+                socket.SO_ERROR)
+        if result and transfer.addresses:
+            self._log.debug('Error connecting to %s (%s), trying the next '
+                    'address' % (transfer.host,
+                        errno.errorcode.get(result, result)))
+            self._release(transfer, False)
+            self._connect(transfer)
+            return
+        if result:
+            raise socket.error(result, errno.errorcode.get(result, result))
+
+        if transfer.key[0] == 'https':
+            if self._ssl_context is None:
+                # verifies the certificates, like httplib does
+                self._ssl_context = ssl.create_default_context()
+            transfer.sock = self._ssl_context.wrap_socket(transfer.sock,
+                    server_hostname=transfer.host,
+                    do_handshake_on_connect=False)
+            transfer.state = transfer.HANDSHAKE
+            transfer.handshake_write = False
+            self._handshake(transfer)
+            return
+
+        self._send_request(transfer)
+        return
+
+    def _handshake(self, transfer):
+        """Continue the SSL handshake."""
+        try:
+            transfer.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            transfer.handshake_write = False
+            return
+        except ssl.SSLWantWriteError:
+            transfer.handshake_write = True
+            return
+
+        self._send_request(transfer)
+        return
+
+    def _send_request(self, transfer):
+        """Build the request; it will be sent once the socket is
+        writable."""
+        if transfer.body:
+            method = 'POST'
+        else:
+            method = 'GET'
+        transfer.method = method
+
+        lines = ['%s %s HTTP/1.1' % (method, transfer.path),
+                'Host: %s' % (transfer.host_header)]
+        for key in transfer.headers:
+            lines.append('%s: %s' % (key, transfer.headers[key]))
+        if transfer.body:
+            lines.append('Content-Length: %d' % (len(transfer.body)))
+        lines.append('')
+        lines.append('')
+
+        transfer.outgoing = '\r\n'.join(lines) + (transfer.body or '')
+        transfer.state = transfer.SENDING
+
+        # response parsing
+        transfer.received = 0
+        transfer.buffer = ''
+        transfer.response = None
+        transfer.parts = []
+        transfer.decoder = None
+        transfer.remaining = None
+        transfer.chunked = False
+        transfer.chunk_left = None
+        transfer.chunk_crlf = False
+        transfer.trailer = False
+        return
+
+    def _write(self, transfer):
+        """Send more of the request."""
+        sent = transfer.sock.send(transfer.outgoing)
+        transfer.outgoing = transfer.outgoing[sent:]
+        if not transfer.outgoing:
+            transfer.state = transfer.HEAD
+        return
+
+    def _read(self, transfer):
+        """Read whatever the socket has for us."""
+        while transfer.state in (transfer.HEAD, transfer.BODY):
+            try:
+                data = transfer.sock.recv(self.CHUNK_SIZE)
+            except ssl.SSLWantReadError:
+                return
+            except socket.error, exc:
+                if exc.args and exc.args[0] in _WOULD_BLOCK:
+                    return
+                raise
+
+            if not data:
+                self._eof(transfer)
+                return
+
+            transfer.received += len(data)
+            if transfer.state == transfer.HEAD:
+                transfer.buffer += data
+                self._parse_head(transfer)
+            else:
+                self._parse_body(transfer, data)
+        return
+
+    def _eof(self, transfer):
+        """The server closed the connection."""
+        if transfer.state == transfer.HEAD:
+            if transfer.reused and not transfer.body and \
+                    not transfer.buffer:
+                self._retry(transfer)
+                return
+            raise ProtocolError('Connection closed before the response')
+
+        if transfer.remaining is None and not transfer.chunked:
+            # the body ends when the connection closes
+            self._finish(transfer, False)
+            return
+
+        raise ProtocolError('Connection closed in the middle of the body')
+
+    def _parse_head(self, transfer):
+        """Parse the status line and the headers, once we have them."""
+        end = transfer.buffer.find('\r\n\r\n')
+        if end < 0:
+            if len(transfer.buffer) > 64 * 1024:
+                raise ProtocolError('Headers too long')
+            return
+
+        head = transfer.buffer[:end].split('\r\n')
+        rest = transfer.buffer[end + 4:]
+        transfer.buffer = ''
+
+        status_line = head[0].split(None, 2)
+        if len(status_line) < 2 or not status_line[0].startswith('HTTP/'):
+            raise ProtocolError('Bad status line: %r' % (head[0]))
+        try:
+            status = int(status_line[1])
+        except ValueError:
+            raise ProtocolError('Bad status line: %r' % (head[0]))
+
+        headers = {}
+        for line in head[1:]:
+            if ':' not in line:
+                continue
+            (key, value) = line.split(':', 1)
+            key = key.strip().lower()
+            if key in headers:
+                headers[key] = '%s, %s' % (headers[key], value.strip())
+            else:
+                headers[key] = value.strip()
+
+        if 100 <= status < 200:
+            # interim response; the real one comes next
+            transfer.buffer = rest
+            self._parse_head(transfer)
+            return
+
+        response = AsyncResponse(status_line[0], status, headers)
+        transfer.response = response
+        transfer.received = len(rest)
+        transfer.state = transfer.BODY
+
+        if callable(transfer.request.jsonify) and status == 200:
+            # statuses are decoded while they arrive
+            response.stream = JSONStream(transfer.request.jsonify)
+
+        encoding = response.getheader('content-encoding', '').lower()
+        if encoding in ('gzip', 'x-gzip'):
+            transfer.decoder = Decoder('gzip')
+        elif encoding == 'deflate':
+            transfer.decoder = Decoder('deflate')
+
+        if status in (204, 304) or transfer.method == 'HEAD':
+            transfer.remaining = 0
+        elif 'chunked' in response.getheader('transfer-encoding',
+                '').lower():
+            transfer.chunked = True
+        elif response.getheader('content-length'):
+            try:
+                transfer.remaining = int(response.getheader(
+                    'content-length'))
+            except ValueError:
+                raise ProtocolError('Invalid Content-Length')
+
+        if transfer.remaining == 0:
+            self._finish(transfer, True)
+            return
+
+        if rest:
+            self._parse_body(transfer, rest)
+        return
+
+    def _parse_body(self, transfer, data):
+        """Add more data to the response body."""
+        if not transfer.chunked:
+            if transfer.remaining is not None:
+                data = data[:transfer.remaining]
+                transfer.remaining -= len(data)
+            self._add_body(transfer, data)
+            if transfer.remaining == 0:
+                self._finish(transfer, True)
+            return
+
+        transfer.buffer += data
+        while transfer.state == transfer.BODY:
+            if transfer.trailer:
+                end = transfer.buffer.find('\r\n')
+                if end < 0:
+                    return
+                line = transfer.buffer[:end]
+                transfer.buffer = transfer.buffer[end + 2:]
+                if not line:
+                    self._finish(transfer, True)
+                continue
+
+            if transfer.chunk_crlf:
+                if len(transfer.buffer) < 2:
+                    return
+                transfer.buffer = transfer.buffer[2:]
+                transfer.chunk_crlf = False
+
+            if transfer.chunk_left is None:
+                end = transfer.buffer.find('\r\n')
+                if end < 0:
+                    return
+                try:
+                    size = int(transfer.buffer[:end].split(';')[0], 16)
+                except ValueError:
+                    raise ProtocolError('Invalid chunk size')
+                transfer.buffer = transfer.buffer[end + 2:]
+                if size == 0:
+                    transfer.trailer = True
+                    continue
+                transfer.chunk_left = size
+
+            chunk = transfer.buffer[:transfer.chunk_left]
+            if not chunk:
+                return
+            transfer.buffer = transfer.buffer[len(chunk):]
+            transfer.chunk_left -= len(chunk)
+            self._add_body(transfer, chunk)
+            if transfer.chunk_left == 0:
+                transfer.chunk_left = None
+                transfer.chunk_crlf = True
+        return
+
+    def _add_body(self, transfer, data):
+        """Store (and decompress) a piece of the body."""
+        transfer.response.compressed_size += len(data)
+        if transfer.decoder:
+            data = transfer.decoder.decompress(data)
+        if transfer.response.stream:
+            transfer.response.stream.feed(data)
+        else:
+            transfer.parts.append(data)
+        return
+
+    def _finish(self, transfer, framed):
+        """The response is complete. <framed> is True if we know where the
+        body ended (so the connection can be reused.)"""
+        response = transfer.response
+        stream = response.stream
+        if stream:
+            if transfer.decoder:
+                stream.feed(transfer.decoder.flush())
+            response.data = stream.data()
+            response.size = stream.size
+        else:
+            if transfer.decoder:
+                transfer.parts.append(transfer.decoder.flush())
+            response.data = ''.join(transfer.parts)
+            response.size = len(response.data)
+        transfer.state = transfer.DONE
+
+        self.bytes_received += response.compressed_size
+        self.bytes_decoded += response.size
+
+        keep_alive = framed and response.version == 'HTTP/1.1' and \
+                response.getheader('connection', '').lower() != 'close'
+        self._release(transfer, keep_alive)
+
+        location = response.getheader('location')
+        if response.status in (301, 302, 303, 307) and location and \
+                transfer.redirects < self.MAX_REDIRECTS:
+            # same as ThreadHTTP: follow the redirect, dropping the body
+            transfer.redirects += 1
+            transfer.url = urlparse.urljoin(transfer.url, location)
+            self._log.debug('Redirected to %s' % (transfer.url))
+            if response.status != 307:
+                transfer.body = None
+                transfer.headers.pop('Content-Type', None)
+            self._open(transfer)
+            return
+
+        self._active.remove(transfer)
+
+        if response.status < 200 or response.status >= 300:
+            self._log.debug('HTTPError: %d' % (response.status))
+            self._log.debug('HTTPError: response body:\n%s'
+                                    % response.data)
+            status = response.status
+            data = None
+        else:
+            self._log.debug('Request completed')
+            status = None
+            data = response.data
+
+        self._result(transfer.request, transfer.cached, status, data,
+                response)
+        return
+
+    def cancel_all(self):
+        """Cancel all the requests running in the engine. Can be called from
+        any thread; the transfers are aborted by the loop itself."""
+        for transfer in self._active[:]:
+            transfer.request.cancel()
+        return
+
+    def _cancel(self, transfer):
+        """The request of <transfer> was cancelled; drop the connection."""
+        self._log.debug('Aborting request of %s' % (transfer.url))
+        self._release(transfer, False)
+        transfer.state = transfer.DONE
+        self._active.remove(transfer)
+        self.breaker.release(transfer.request.host)
+        self._complete(transfer.request, None, self.CANCELLED, None, None)
+        return
+
+    def _fail(self, transfer, status):
+        """Give up on <transfer>, sending the error <status> to its
+        callback."""
+        self._release(transfer, False)
+        transfer.state = transfer.DONE
+        if transfer in self._active:
+            self._active.remove(transfer)
+        self._result(transfer.request, transfer.cached, status, None, None)
+        return
+
@@ -0,0 +1,344 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Mitter, a client for Twitter.
+# Copyright (C) 2007, 2008 The Mitter Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import bisect
+import threading
+
+_url_re = re.compile(r'https?://[^\s]+', re.I)
+_word_re = re.compile(r'\w+', re.UNICODE)
+_mention_re = re.compile(r'@(\w+)', re.UNICODE)
+_query_re = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def _words(text):
+    """Return the (lowercase) words in <text>."""
+    return [word.lower() for word in _word_re.findall(text)]
+
+
+def _insert_sorted(items, new):
+    """Insert the <new> items in the sorted list <items>. Returns the list
+    with all of them, which may not be <items> itself."""
+    if len(new) > 32:
+        # sorting two sorted runs together is linear, which is better than
+        # moving the whole list for every item
+        new.sort()
+        return sorted(items + new)
+    for item in new:
+        bisect.insort(items, item)
+    return items
+
+
+class SearchIndex(object):
+    """An inverted index of statuses, for searching the ones we already
+    have.
+
+    The terms of a status are the words of its text, the URLs in it (whole)
+    and the screen names of the user who posted it and the users mentioned
+    in it, which are prefixed by '@'. Each term points to the set of ids of
+    the statuses with it. The words of each status are kept, in order, to
+    check the phrases.
+
+    A query is a list of terms, which must all be in the statuses found:
+    'word', '@user', 'http://some.url', 'prefix*' or '"a phrase"'."""
+
+    # when there are less statuses than this left, the prefixes are checked
+    # in them instead of looked up in the index
+    SCAN_LIMIT = 1000
+
+    # when a prefix is in lots of statuses and we only want the newest ones,
+    # it's faster to check the statuses from the newest to the oldest until
+    # we have enough than to collect all of them; checking a status costs
+    # about as much as collecting SCAN_COST ids from the index
+    SCAN_COST = 25
+
+    # how many prefixes we keep the statuses of
+    MAX_PREFIXES = 32
+
+    def __init__(self):
+        self._postings = {}         # term -> set of ids
+        self._documents = {}        # id -> (terms, words)
+        self._ids = []              # all ids, sorted
+        self._terms = []            # all terms, sorted
+        self._prefixes = {}         # prefix -> ids (kept up to date)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __contains__(self, id):
+        return int(id) in self._documents
+
+    # indexing
+
+    def _analyze(self, status):
+        """Return the (terms, words) of <status>."""
+        text = status['text']
+        words = tuple(_words(text))
+
+        terms = set(words)
+        terms.update([url.lower() for url in _url_re.findall(text)])
+        terms.update(['@' + name.lower() for name in
+            _mention_re.findall(text)])
+        terms.add('@' + status['user']['screen_name'].lower())
+        return (tuple(terms), words)
+
+    def add(self, statuses):
+        """Index the <statuses> (the ones already indexed are ignored.)"""
+        self._lock.acquire()
+        try:
+            new_ids = []
+            new_terms = []
+            for status in statuses:
+                id = int(status['id'])
+                if id in self._documents:
+                    continue
+
+                (terms, words) = self._analyze(status)
+                self._documents[id] = (terms, words)
+                new_ids.append(id)
+                for term in terms:
+                    postings = self._postings.get(term)
+                    if postings is None:
+                        postings = self._postings[term] = set()
+                        new_terms.append(term)
+                    postings.add(id)
+
+                for (prefix, ids) in self._prefixes.iteritems():
+                    if self._has_prefix(id, prefix):
+                        ids.add(id)
+
+            self._ids = _insert_sorted(self._ids, new_ids)
+            self._terms = _insert_sorted(self._terms, new_terms)
+        finally:
+            self._lock.release()
+        return
+
+    def remove(self, id):
+        """Remove the status <id> from the index."""
+        id = int(id)
+        self._lock.acquire()
+        try:
+            document = self._documents.pop(id, None)
+            if document is not None:
+                del self._ids[bisect.bisect_left(self._ids, id)]
+                for term in document[0]:
+                    postings = self._postings[term]
+                    postings.discard(id)
+                    if not postings:
+                        del self._postings[term]
+                        del self._terms[bisect.bisect_left(self._terms,
+                            term)]
+                for ids in self._prefixes.itervalues():
+                    ids.discard(id)
+        finally:
+            self._lock.release()
+        return
+
+    def clear(self):
+        """Forget all the statuses."""
+        self._lock.acquire()
+        try:
+            self._postings = {}
+            self._documents = {}
+            self._ids = []
+            self._terms = []
+            self._prefixes = {}
+        finally:
+            self._lock.release()
+        return
+
+    # searching
+
+    def _parse(self, query):
+        """Split <query> in a list of (kind, value), where kind is 'term',
+        'prefix' or 'phrase' (with a tuple of words as value.)"""
+        parts = []
+        for (phrase, term) in _query_re.findall(query):
+            if phrase:
+                words = tuple(_words(phrase))
+            elif _url_re.match(term):
+                parts.append(('term', term.lower()))
+                continue
+            elif term.endswith('*') and len(term) > 1:
+                parts.append(('prefix', term[:-1].lower()))
+                continue
+            elif term.startswith('@') and len(term) > 1:
+                parts.append(('term', '@' + ''.join(_words(term[1:]))))
+                continue
+            else:
+                # things like "don't" are two words, one after the other
+                words = tuple(_words(term))
+
+            if len(words) == 1:
+                parts.append(('term', words[0]))
+            elif words:
+                parts.append(('phrase', words))
+        return parts
+
+    def _prefix_terms(self, prefix):
+        """Return the terms starting with <prefix>."""
+        start = bisect.bisect_left(self._terms, prefix)
+        end = start
+        while end < len(self._terms) and \
+                self._terms[end].startswith(prefix):
+            end += 1
+        return self._terms[start:end]
+
+    def _prefixed(self, prefix):
+        """Return the ids of the statuses with any term starting with
+        <prefix>."""
+        ids = self._prefixes.get(prefix)
+        if ids is not None:
+            # while the user types, the same prefix is searched again and
+            # again
+            return ids
+
+        ids = set()
+        for term in self._prefix_terms(prefix):
+            ids.update(self._postings[term])
+
+        if len(self._prefixes) >= self.MAX_PREFIXES:
+            self._prefixes = {}
+        self._prefixes[prefix] = ids
+        return ids
+
+    def _common(self, prefix, limit):
+        """True if <prefix> is in so many statuses that checking the newest
+        ones until we find <limit> of them is faster than collecting all of
+        them."""
+        if prefix in self._prefixes:
+            return False
+        count = 0
+        for term in self._prefix_terms(prefix):
+            count += len(self._postings[term])
+
+        # we'd check about limit * documents / count statuses, against
+        # collecting count ids
+        return count * count > self.SCAN_COST * limit * len(self._documents)
+
+    def _newest(self, prefixes, phrases, limit):
+        """Return the newest <limit> statuses with all the <prefixes> and
+        <phrases>, from the newest to the oldest."""
+        found = []
+        for id in reversed(self._ids):
+            for prefix in prefixes:
+                if not self._has_prefix(id, prefix):
+                    break
+            else:
+                for phrase in phrases:
+                    if not self._has_phrase(id, phrase):
+                        break
+                else:
+                    found.append(id)
+                    if len(found) >= limit:
+                        break
+        return found
+
+    def _has_prefix(self, id, prefix):
+        """True if the status <id> has a term starting with <prefix>."""
+        for term in self._documents[id][0]:
+            if term.startswith(prefix):
+                return True
+        return False
+
+    def _has_phrase(self, id, phrase):
+        """True if the words of the status <id> have the <phrase>."""
+        words = self._documents[id][1]
+        size = len(phrase)
+        for position in xrange(len(words) - size + 1):
+            if words[position:position + size] == phrase:
+                return True
+        return False
+
+    def _newest_of(self, ids, limit):
+        """Return the newest <limit> of <ids> (all of them, if <limit> is
+        None), from the newest to the oldest."""
+        if limit is None or len(ids) <= limit:
+            return sorted(ids, reverse=True)
+
+        if len(ids) * len(ids) < limit * len(self._ids):
+            # not that many, sorting them is faster
+            return sorted(ids, reverse=True)[:limit]
+
+        # lots of them, so we find enough of them soon going through all the
+        # statuses from the newest
+        if not isinstance(ids, set):
+            ids = set(ids)
+        found = []
+        for id in reversed(self._ids):
+            if id in ids:
+                found.append(id)
+                if len(found) >= limit:
+                    break
+        return found
+
+    def search(self, query, limit=None):
+        """Return the ids of the statuses which match <query>, from the
+        newest to the oldest. If <limit> is set, only the newest <limit>
+        ones are returned."""
+        parts = self._parse(query)
+        if not parts:
+            return []
+
+        self._lock.acquire()
+        try:
+            sets = []
+            prefixes = []
+            phrases = []
+            for (kind, value) in parts:
+                if kind == 'term':
+                    sets.append(self._postings.get(value, set()))
+                elif kind == 'prefix':
+                    prefixes.append(value)
+                else:
+                    for word in value:
+                        sets.append(self._postings.get(word, set()))
+                    phrases.append(value)
+
+            if sets:
+                # start with the smallest set, so we check as few as
+                # possible
+                sets.sort(key=len)
+                ids = sets[0].intersection(*sets[1:])
+            elif limit is not None and self._common(max(prefixes,
+                    key=len), limit):
+                # e.g., the user just typed the first letters
+                return self._newest(prefixes, phrases, limit)
+            else:
+                # the longest prefix should match less terms
+                prefixes.sort(key=len)
+                ids = self._prefixed(prefixes.pop())
+
+            for prefix in prefixes:
+                if len(ids) < self.SCAN_LIMIT:
+                    # a short prefix may match lots of terms, so it's faster
+                    # to check the terms of the few statuses we have
+                    ids = [id for id in ids if self._has_prefix(id, prefix)]
+                else:
+                    ids = self._prefixed(prefix).intersection(ids)
+
+            for phrase in phrases:
+                ids = [id for id in ids if self._has_phrase(id, phrase)]
+
+            # (ids may be one of the sets we keep, which can't change while
+            # we go through it)
+            return self._newest_of(ids, limit)
+        finally:
+            self._lock.release()
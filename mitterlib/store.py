@@ -0,0 +1,463 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Mitter, a client for Twitter.
+# Copyright (C) 2007, 2008 The Mitter Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import os.path
+import struct
+import zlib
+import calendar
+import datetime
+import heapq
+import threading
+import logging
+import json
+
+from twitter import Status, User
+
+
+def open_store(username, timeline='friends_timeline', path=None,
+        index=None):
+    """Return the TweetStore of the <timeline> of <username>. By default,
+    the stores live in ~/.mitter/tweets. <index> is passed to the
+    store."""
+    if path is None:
+        path = os.path.expanduser(os.path.join('~', '.mitter', 'tweets'))
+    return TweetStore(os.path.join(path, username or 'anonymous',
+        timeline), index=index)
+
+
+class TweetStore(object):
+    """Keeps the statuses on disk, so the interfaces don't start empty.
+
+    The statuses go to a log file, which is only appended to. Each line of
+    the log is a record (in JSON) preceded by its checksum, so a line left
+    half written by a crash is recognized (and removed) the next time the
+    store is opened; deleting a status appends a record saying so. The first
+    line of the log has its generation, which changes every time the log is
+    compacted.
+
+    The index file has the offset of each status in the log and how much of
+    the log it covers, so opening the store only needs to read the records
+    appended after the index was saved. If the index is missing or is from
+    another generation, the whole log is read again.
+
+    compact() writes a new log with only the newest <max_tweets> statuses,
+    and is called by close() when more than half the log is garbage (or the
+    store has too many statuses.)
+
+    If there is an <index> (a SearchIndex), it has the same statuses as the
+    store: the stored ones when it's opened, and then the ones added and
+    removed (including by compact().)"""
+
+    LOG = 'tweets.log'
+    INDEX = 'tweets.idx'
+
+    _index_header = struct.Struct('<4sQQ')     # magic, generation, covered
+    _index_entry = struct.Struct('<qQ')        # id, offset
+    _magic = 'MTIX'
+
+    def __init__(self, path, max_tweets=5000, index=None):
+        self.path = path
+        self.max_tweets = max_tweets
+        self.index = index
+
+        self._offsets = {}      # id -> offset of the record in the log
+        self._garbage = 0       # records in the log which are not used
+        self._generation = 0
+        self._log_file = None
+        self._lock = threading.RLock()
+        self._log = logging.getLogger('mitterlib.store')
+
+        self._open()
+        if index is not None:
+            index.add(self.latest(len(self)))
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, id):
+        return int(id) in self._offsets
+
+    # the records
+
+    def _encode(self, record):
+        """Return the log line of <record>."""
+        payload = json.dumps(record, separators=(',', ':'))
+        return '%08x %s\n' % (zlib.crc32(payload) & 0xffffffff, payload)
+
+    def _decode(self, line):
+        """Return the record in a log <line>, or None if the line is
+        broken."""
+        if not line.endswith('\n') or line[8:9] != ' ':
+            return None
+        payload = line[9:-1]
+        try:
+            if int(line[:8], 16) != zlib.crc32(payload) & 0xffffffff:
+                return None
+            return json.loads(payload)
+        except ValueError:
+            return None
+
+    def _to_record(self, status):
+        """Convert a <status> (a Status, or a dictionary like it) to the
+        record we store."""
+        user = status['user']
+        return {
+                'id': int(status['id']),
+                'text': status['text'],
+                'created_at': calendar.timegm(
+                    status['created_at'].timetuple()),
+                'in_reply_to_status_id': status.get('in_reply_to_status_id'),
+                'user': {
+                    'id': user.get('id'),
+                    'name': user['name'],
+                    'screen_name': user['screen_name'],
+                    'profile_image_url': user['profile_image_url']}}
+
+    def _to_status(self, record):
+        """Convert a stored <record> back to a Status."""
+        return Status(record['id'], record['text'],
+                datetime.datetime.utcfromtimestamp(record['created_at']),
+                record.get('in_reply_to_status_id'),
+                User.shared(record['user']))
+
+    # opening
+
+    def _open(self):
+        """Open the log (creating it if needed) and load the index."""
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            # already exists (or we can't create it, in which case we'll
+            # find out next)
+            pass
+
+        filename = os.path.join(self.path, self.LOG)
+        if not os.path.exists(filename):
+            self._create(filename, 1)
+
+        self._log_file = file(filename, 'r+b')
+        header = self._decode(self._log_file.readline())
+        if not header or 'generation' not in header:
+            # not even the header survived; nothing to recover
+            self._log.error('Broken tweet log, starting a new one')
+            self._log_file.close()
+            self._create(filename, 1)
+            self._log_file = file(filename, 'r+b')
+            header = self._decode(self._log_file.readline())
+        self._generation = header['generation']
+
+        covered = self._load_index()
+        if covered is None:
+            self._offsets = {}
+            self._garbage = 0
+            covered = self._log_file.tell()
+        self._scan(covered)
+
+        self._log.debug('%d tweets in %s (%d garbage records)' %
+                (len(self._offsets), self.path, self._garbage))
+        return
+
+    def _create(self, filename, generation):
+        """Write an empty log with the header of <generation>."""
+        log = file(filename, 'wb')
+        log.write(self._encode({'generation': generation}))
+        log.flush()
+        os.fsync(log.fileno())
+        log.close()
+        return
+
+    def _load_index(self):
+        """Load the offsets from the index. Returns how much of the log the
+        index covers, or None if it can't be used."""
+        try:
+            index = file(os.path.join(self.path, self.INDEX), 'rb')
+            try:
+                data = index.read()
+            finally:
+                index.close()
+        except IOError:
+            return None
+
+        header_size = self._index_header.size
+        entry_size = self._index_entry.size
+        if len(data) < header_size or \
+                (len(data) - header_size) % entry_size:
+            return None
+
+        (magic, generation, covered) = self._index_header.unpack_from(data)
+        self._log_file.seek(0, 2)
+        if magic != self._magic or generation != self._generation or \
+                covered > self._log_file.tell():
+            self._log.debug('Tweet index is stale, reading the whole log')
+            return None
+
+        offsets = {}
+        for position in xrange(header_size, len(data), entry_size):
+            (id, offset) = self._index_entry.unpack_from(data, position)
+            offsets[id] = offset
+        self._offsets = offsets
+
+        # we don't know how many of the old records are garbage, but the
+        # ones covered by the index are at least the records not in it
+        self._garbage = 0
+        return covered
+
+    def _scan(self, offset):
+        """Read the records of the log starting at <offset>. A broken line
+        at the end (from a crash in the middle of an append) is cut off."""
+        self._log_file.seek(offset)
+        while True:
+            line = self._log_file.readline()
+            if not line:
+                break
+
+            record = self._decode(line)
+            if record is None:
+                if not line.endswith('\n'):
+                    self._log.error('Removing incomplete record at the end '
+                            'of the tweet log')
+                    self._log_file.truncate(offset)
+                    break
+                # damaged in the middle; nothing we can do but skip it
+                self._log.error('Skipping damaged record in the tweet log')
+                self._garbage += 1
+                offset += len(line)
+                continue
+
+            id = record.get('id')
+            if id is not None:
+                if id in self._offsets:
+                    self._garbage += 1
+                if record.get('deleted'):
+                    if self._offsets.pop(id, None) is not None:
+                        self._garbage += 1
+                    self._garbage += 1
+                else:
+                    self._offsets[id] = offset
+            offset += len(line)
+
+        self._log_file.seek(0, 2)
+        return
+
+    # changing the store
+
+    def _append(self, records):
+        """Append the <records> to the log; returns the offset of each."""
+        self._log_file.seek(0, 2)
+        offset = self._log_file.tell()
+        offsets = []
+        lines = []
+        for record in records:
+            line = self._encode(record)
+            offsets.append(offset)
+            lines.append(line)
+            offset += len(line)
+
+        self._log_file.write(''.join(lines))
+        self._log_file.flush()
+        os.fsync(self._log_file.fileno())
+        return offsets
+
+    def add(self, statuses):
+        """Store the <statuses> which are not stored yet. Returns the ones
+        which were added (none, if the store was closed.)"""
+        self._lock.acquire()
+        try:
+            added = []
+            if self._log_file is None:
+                self._log.debug('Tweet store is closed, not adding')
+                return added
+
+            seen = set()
+            for status in statuses:
+                id = int(status['id'])
+                if id in self._offsets or id in seen:
+                    continue
+                seen.add(id)
+                added.append(status)
+
+            if added:
+                offsets = self._append([self._to_record(status) for status
+                    in added])
+                for (status, offset) in zip(added, offsets):
+                    self._offsets[int(status['id'])] = offset
+                if self.index is not None:
+                    self.index.add(added)
+        finally:
+            self._lock.release()
+        return added
+
+    def remove(self, id):
+        """Remove the status <id> from the store."""
+        id = int(id)
+        self._lock.acquire()
+        try:
+            if self._log_file is None:
+                self._log.debug('Tweet store is closed, not removing')
+                return
+            if self._offsets.pop(id, None) is not None:
+                self._append([{'id': id, 'deleted': True}])
+                self._garbage += 2
+                if self.index is not None:
+                    self.index.remove(id)
+        finally:
+            self._lock.release()
+        return
+
+    # reading
+
+    def _read(self, id):
+        """Return the stored record of status <id>, or None."""
+        offset = self._offsets.get(id)
+        if offset is None or self._log_file is None:
+            return None
+
+        self._log_file.seek(offset)
+        record = self._decode(self._log_file.readline())
+        self._log_file.seek(0, 2)
+        if not record or record.get('id') != id:
+            self._log.error('Tweet index out of sync with the log')
+            return None
+        return record
+
+    def get(self, id):
+        """Return the status <id>, or None if it's not stored."""
+        self._lock.acquire()
+        try:
+            record = self._read(int(id))
+        finally:
+            self._lock.release()
+
+        if record is None:
+            return None
+        return self._to_status(record)
+
+    def latest(self, count):
+        """Return the newest <count> statuses, from the newest to the
+        oldest."""
+        self._lock.acquire()
+        try:
+            records = [self._read(id) for id in
+                    heapq.nlargest(count, self._offsets)]
+        finally:
+            self._lock.release()
+        return [self._to_status(record) for record in records if record]
+
+    def newest_id(self):
+        """Return the id of the newest stored status (0 if there is
+        none.)"""
+        if not self._offsets:
+            return 0
+        return max(self._offsets)
+
+    # maintenance
+
+    def save(self):
+        """Write the index, so the next open doesn't need to read the whole
+        log."""
+        self._lock.acquire()
+        try:
+            self._log_file.seek(0, 2)
+            covered = self._log_file.tell()
+            entries = [self._index_entry.pack(id, offset) for (id, offset) in
+                    self._offsets.iteritems()]
+            data = self._index_header.pack(self._magic, self._generation,
+                    covered) + ''.join(entries)
+        finally:
+            self._lock.release()
+
+        filename = os.path.join(self.path, self.INDEX)
+        try:
+            # write somewhere else first, so a crash doesn't leave half an
+            # index behind
+            index = file(filename + '.tmp', 'wb')
+            index.write(data)
+            index.close()
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError), exc:
+            self._log.error('Error saving the tweet index: %s' % (exc))
+        return
+
+    def compact(self):
+        """Write a new log with only the newest max_tweets statuses (and
+        nothing which was removed), replacing the current one."""
+        self._lock.acquire()
+        try:
+            keep = heapq.nlargest(self.max_tweets, self._offsets)
+            keep.reverse()      # oldest first, like they were appended
+            records = [self._read(id) for id in keep]
+
+            generation = self._generation + 1
+            filename = os.path.join(self.path, self.LOG)
+            log = file(filename + '.tmp', 'wb')
+            log.write(self._encode({'generation': generation}))
+            offsets = {}
+            for record in records:
+                if record is None:
+                    continue
+                offsets[record['id']] = log.tell()
+                log.write(self._encode(record))
+            log.flush()
+            os.fsync(log.fileno())
+            log.close()
+
+            # the new log only becomes the log when it's complete; if we
+            # crash after this, the index is from the old generation and
+            # will be rebuilt
+            self._log_file.close()
+            os.rename(filename + '.tmp', filename)
+            self._log_file = file(filename, 'r+b')
+            self._log_file.seek(0, 2)
+
+            self._log.debug('Tweet log compacted: %d tweets, %d records '
+                    'removed' % (len(offsets), self._garbage +
+                        len(self._offsets) - len(offsets)))
+            if self.index is not None:
+                for id in self._offsets:
+                    if id not in offsets:
+                        self.index.remove(id)
+            self._offsets = offsets
+            self._generation = generation
+            self._garbage = 0
+        finally:
+            self._lock.release()
+
+        self.save()
+        return
+
+    def close(self):
+        """Save the index (compacting the log, if it is worth it) and close
+        the store."""
+        if self._log_file is None:
+            return
+
+        if self._garbage > len(self._offsets) or \
+                len(self._offsets) > self.max_tweets:
+            self.compact()
+        else:
+            self.save()
+
+        self._lock.acquire()
+        try:
+            self._log_file.close()
+            self._log_file = None
+        finally:
+            self._lock.release()
+        return
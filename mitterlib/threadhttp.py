@@ -19,22 +19,999 @@
 
 import threading
 import urllib
-import urllib2
+import urlparse
+import httplib
+import socket
 import logging
 import Queue
+import time
+import zlib
+import heapq
+import random
 import re
+import json
 
-try:
-    # Python 2.6/3.0 JSON parser
-    import json
-except ImportError:
-    # Fallback to SimpleJSON
-    import simplejson as json
+# OrderedDict is why Mitter needs (at least) Python 2.7
+from collections import OrderedDict, deque
 
 from httplib import BadStatusLine
 from socket import error
 
 
+class ConnectionPool(object):
+    """Keeps HTTP/1.1 connections open between requests, so we don't need to
+    open a new TCP connection (and, worse, do a new SSL handshake) every time
+    we talk to the same server. The pool is thread-safe and it's meant to be
+    shared by all the ThreadHTTP workers."""
+
+    def __init__(self, max_idle=4, idle_timeout=60, timeout=30):
+        """<max_idle> is the number of idle connections kept per host;
+        connections idle for more than <idle_timeout> seconds are closed
+        instead of reused. <timeout> is the socket timeout for new
+        connections."""
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self._idle = {}     # (scheme, host, port) -> [(last used, conn)]
+        self._lock = threading.Lock()
+        self._log = logging.getLogger('mitterlib.threadhttp.pool')
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _connect(self, scheme, host, port):
+        """Open a new connection to the server."""
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        return httplib.HTTPConnection(host, port, timeout=self.timeout)
+
+    def get(self, scheme, host, port):
+        """Return a tuple with a connection to the server and a flag telling
+        if the connection was reused (in which case the server may have
+        closed it in the meantime and the caller should be ready to retry.)"""
+        key = (scheme, host, port)
+        now = time.time()
+
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key, [])
+            while idle:
+                (last_used, conn) = idle.pop()
+                if conn.sock is None or \
+                        now - last_used > self.idle_timeout:
+                    # expired or already closed; no use for it anymore
+                    self.evictions += 1
+                    self._close(conn)
+                    continue
+
+                self.hits += 1
+                return (conn, True)
+
+            self.misses += 1
+        finally:
+            self._lock.release()
+
+        self._log.debug('New connection to %s://%s:%s' % (scheme, host,
+            port))
+        return (self._connect(scheme, host, port), False)
+
+    def put(self, scheme, host, port, conn):
+        """Give the connection back to the pool, so it can be reused."""
+        if conn.sock is None:
+            # the server closed it (or we did)
+            return
+
+        key = (scheme, host, port)
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) >= self.max_idle:
+                self.evictions += 1
+                self._close(conn)
+                return
+            idle.append((time.time(), conn))
+        finally:
+            self._lock.release()
+        return
+
+    def discard(self, conn):
+        """Close a connection that can't be reused."""
+        self._close(conn)
+
+    def _close(self, conn):
+        """Close the connection, ignoring any errors (the connection is
+        probably broken already.)"""
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def clear(self):
+        """Close all the idle connections."""
+        self._lock.acquire()
+        try:
+            for idle in self._idle.itervalues():
+                for (_, conn) in idle:
+                    self._close(conn)
+            self._idle = {}
+        finally:
+            self._lock.release()
+
+        self._log.debug('Pool stats: %s' % (self.stats()))
+        return
+
+    def stats(self):
+        """Return the pool hit/miss counters."""
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class ValidatorCache(object):
+    """Remembers the ETag and Last-Modified headers of the responses, so the
+    next request for the same URL can be a conditional one. When the server
+    answers with a "304 Not Modified", we give back the data we decoded the
+    last time, without parsing it again.
+
+    The cache is limited both in number of entries and in (approximated)
+    size; the least recently used entries are removed first."""
+
+    def __init__(self, max_entries=64, max_bytes=1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()   # url -> (etag, modified, data, size)
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, url):
+        """Return the cached (etag, last_modified, data, size) for <url>, or
+        None if there is nothing cached."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(url, None)
+            if entry is not None:
+                # put it back in the end, as the most recently used
+                self._entries[url] = entry
+            return entry
+        finally:
+            self._lock.release()
+
+    def headers(self, entry):
+        """Return the headers to make a conditional request for the cached
+        <entry>."""
+        (etag, last_modified, _, _) = entry
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def put(self, url, etag, last_modified, data, size):
+        """Cache the decoded <data> of <url>. <size> is the size of the
+        original response, used to keep the cache under <max_bytes>."""
+        if not etag and not last_modified:
+            # nothing to validate against later
+            return
+
+        if size > self.max_bytes:
+            return
+
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(url, None)
+            if old is not None:
+                self._size -= old[3]
+
+            self._entries[url] = (etag, last_modified, data, size)
+            self._size += size
+
+            while len(self._entries) > self.max_entries or \
+                    self._size > self.max_bytes:
+                (_, old) = self._entries.popitem(last=False)
+                self._size -= old[3]
+                self.evictions += 1
+        finally:
+            self._lock.release()
+        return
+
+    def touch(self, url):
+        """The server confirmed the entry of <url> is still valid."""
+        self.get(url)
+        return
+
+    def stats(self):
+        """Return the cache counters."""
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._size}
+
+
+class Request(object):
+    """A request waiting (or being processed) by the workers. It's also the
+    handle returned to whoever made the request, so it can follow its
+    progress or cancel it."""
+
+    # states of the request
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, callback, url, headers, body, jsonify, cache,
+            priority, args, kwargs):
+        self.callback = callback
+        self.url = url
+        self.headers = headers
+        self.body = body
+        self.jsonify = jsonify
+        self.cache = cache
+        self.priority = priority
+        self.args = args
+        self.kwargs = kwargs
+
+        self.host = urlparse.urlsplit(url)[1]
+        self.attempts = 0
+
+        # set by the scheduler: when the request stops being useful and if it
+        # was thrown away because the queue was full
+        self.deadline = None
+        self.dropped = False
+
+        self.state = self.QUEUED
+        self.status = None          # the status sent to the callback
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        # set by the workers: the request which is actually going to the
+        # network for this one (if it was merged with another) and the
+        # function to abort it while it is running
+        self.leader = None
+        self.abort = None
+
+    def idempotent(self):
+        """True if the request can be repeated without side effects."""
+        return not self.body
+
+    def expired(self, now=None):
+        """True if the deadline of the request already passed."""
+        if self.deadline is None:
+            return False
+        if now is None:
+            now = time.time()
+        return now > self.deadline
+
+    def cancel(self):
+        """Withdraw the request: its callback won't be called. If it is
+        still queued, it will be skipped; if it is running, the connection
+        is dropped (unless some other identical request still wants the
+        result.) Returns False if the request was already finished."""
+        if self.state in (self.DONE, self.CANCELLED):
+            return False
+
+        self.state = self.CANCELLED
+        running = self.leader or self
+        abort = running.abort
+        if abort:
+            abort(running)
+        return True
+
+    def cancelled(self):
+        """True if the request was cancelled."""
+        return self.state == self.CANCELLED
+
+    def started(self):
+        """The request is going to the network."""
+        if self.started_at is None:
+            self.started_at = time.time()
+        if self.state == self.QUEUED:
+            self.state = self.RUNNING
+        return
+
+    def finished(self, status):
+        """The request is done, with <status>."""
+        self.status = status
+        self.finished_at = time.time()
+        if self.started_at is None and self.leader:
+            # merged requests run along with the one they were merged with
+            self.started_at = self.leader.started_at
+        self.abort = None
+        if self.state != self.CANCELLED:
+            self.state = self.DONE
+        return
+
+    def timing(self):
+        """Return how long (in seconds) the request waited in the queue and
+        how long it took since leaving the queue until finished; either is
+        None if it didn't happen (yet.)"""
+        waited = None
+        elapsed = None
+        if self.started_at is not None:
+            waited = max(0, self.started_at - self.queued_at)
+            if self.finished_at is not None:
+                elapsed = self.finished_at - self.started_at
+        return {'waited': waited, 'elapsed': elapsed}
+
+
+class InFlight(object):
+    """Keeps track of the GET requests already queued or running, so an
+    identical request (same URL, same headers) is merged with it instead of
+    going to the network again. Like the pool, it should be shared by all
+    the workers."""
+
+    def __init__(self):
+        self._waiters = {}  # request key -> [requests merged]
+        self._leaders = {}  # request key -> request going to the network
+        self._lock = threading.Lock()
+
+        self.merged = 0
+
+    def _key(self, request):
+        """Return the key identifying the <request>, or None if the request
+        can't be merged."""
+        if not request.idempotent():
+            # POSTs change things on the server; they never get merged
+            return None
+
+        headers = tuple(sorted((request.headers or {}).items()))
+        return (request.url, headers, request.jsonify, request.cache)
+
+    def join(self, request):
+        """If there is a request identical to <request> in flight, add the
+        <request> to the list of requests waiting for it and return True.
+        Otherwise, register <request> as in flight and return False."""
+        key = self._key(request)
+        if key is None:
+            return False
+
+        self._lock.acquire()
+        try:
+            if key in self._waiters:
+                request.leader = self._leaders[key]
+                self._waiters[key].append(request)
+                self.merged += 1
+                return True
+
+            self._waiters[key] = []
+            self._leaders[key] = request
+            return False
+        finally:
+            self._lock.release()
+
+    def wanted(self, request):
+        """True if the result of <request> is still expected by someone,
+        either by itself or by one of the requests merged with it."""
+        if not request.cancelled():
+            return True
+
+        key = self._key(request)
+        if key is None:
+            return False
+
+        self._lock.acquire()
+        try:
+            for waiter in self._waiters.get(key, []):
+                if not waiter.cancelled():
+                    return True
+            return False
+        finally:
+            self._lock.release()
+
+    def cancel_all(self):
+        """Cancel all the requests waiting for the ones in flight (e.g.,
+        because we are closing.)"""
+        self._lock.acquire()
+        try:
+            waiters = []
+            for merged in self._waiters.itervalues():
+                waiters.extend(merged)
+        finally:
+            self._lock.release()
+
+        # cancelling may abort the request in flight, which asks us if
+        # someone still wants it; so not with the lock held
+        for waiter in waiters:
+            waiter.cancel()
+        return
+
+    def finish(self, request):
+        """The <request> is done; return the requests waiting for its
+        result. Requests made after this will go to the network again."""
+        key = self._key(request)
+        if key is None:
+            return []
+
+        self._lock.acquire()
+        try:
+            self._leaders.pop(key, None)
+            return self._waiters.pop(key, [])
+        finally:
+            self._lock.release()
+
+
+class Decoder(object):
+    """Incrementally decompresses a response body sent with gzip or deflate
+    Content-Encoding, so we never have the whole compressed and
+    uncompressed bodies in memory at the same time."""
+
+    def __init__(self, encoding):
+        self._encoding = encoding
+        if encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = zlib.decompressobj()
+        self._first = True
+
+    def decompress(self, chunk):
+        """Decompress another chunk of the body."""
+        try:
+            data = self._decompressor.decompress(chunk)
+        except zlib.error:
+            if self._encoding != 'deflate' or not self._first:
+                raise
+            # some servers send raw deflate data, without the zlib headers
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = self._decompressor.decompress(chunk)
+        self._first = False
+        return data
+
+    def flush(self):
+        """Return whatever is left in the decompressor."""
+        return self._decompressor.flush()
+
+
+class JSONStream(object):
+    """Incrementally decodes a JSON array, while the body is received: each
+    element (which must be an object or an array) is decoded as soon as it
+    is complete and passed to <convert>; what it returns goes to "items".
+    Only the element being received is kept as text. Anything between the
+    elements which isn't JSON (like the "Couldn't find Status" messages
+    Twitter sometimes sends) is skipped.
+
+    If the body is not an array, it is kept as it is and returned by
+    data(), to be decoded the usual way. Errors while decoding (or
+    converting) an element stop the decoding and are kept in "error"."""
+
+    _string_re = re.compile(r'["\\]')
+    _structure_re = re.compile(r'["\[\]{}]')
+
+    def __init__(self, convert):
+        self.convert = convert
+        self.items = []
+        self.array = None       # unknown until the first character
+        self.done = False       # got the end of the array
+        self.error = None
+        self.size = 0
+
+        self._buffer = ''
+        self._position = 0      # where to continue scanning the buffer
+        self._start = None      # where the current element starts
+        self._depth = 0
+        self._in_string = False
+        self._parts = []        # the body, if it isn't an array
+
+    def feed(self, chunk):
+        """Add another <chunk> of the body."""
+        self.size += len(chunk)
+        if self.array is False:
+            self._parts.append(chunk)
+            return
+        if self.done or self.error:
+            return
+
+        buffer = self._buffer + chunk
+        if self.array is None:
+            stripped = buffer.lstrip()
+            if not stripped:
+                return
+            if stripped[0] != '[':
+                self.array = False
+                self._parts.append(buffer)
+                return
+            self.array = True
+            self._position = buffer.index('[') + 1
+            self._depth = 1
+
+        position = self._position
+        while True:
+            if self._in_string:
+                match = self._string_re.search(buffer, position)
+                if not match:
+                    position = len(buffer)
+                    break
+                if match.group() == '\\':
+                    if match.end() == len(buffer):
+                        # the escaped char comes in the next chunk
+                        position = match.start()
+                        break
+                    position = match.end() + 1
+                    continue
+                self._in_string = False
+                position = match.end()
+                continue
+
+            match = self._structure_re.search(buffer, position)
+            if not match:
+                position = len(buffer)
+                break
+
+            char = match.group()
+            position = match.end()
+            if char == '"':
+                self._in_string = True
+            elif char in '[{':
+                if self._depth == 1:
+                    self._start = match.start()
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._depth == 1 and self._start is not None:
+                    try:
+                        self.items.append(self.convert(json.loads(
+                            buffer[self._start:position])))
+                    except Exception, exc:
+                        self.error = str(exc)
+                        return
+                    self._start = None
+                elif self._depth == 0:
+                    self.done = True
+                    break
+
+        # keep only the element being received
+        if self._start is not None:
+            cut = self._start
+            self._start = 0
+        else:
+            cut = position
+        self._buffer = buffer[cut:]
+        self._position = position - cut
+        return
+
+    def data(self):
+        """Return the body, if it isn't an array (None if it is.)"""
+        if self.array:
+            return None
+        return ''.join(self._parts) or self._buffer
+
+    def result(self):
+        """Return the (status, items) of the decoding, like
+        ThreadHTTP._decode()."""
+        if self.error:
+            return (self.error, None)
+        if not self.done:
+            return ('Incomplete JSON array', None)
+        return (None, self.items)
+
+
+class RequestScheduler(object):
+    """A replacement for the Queue shared by the workers which delivers the
+    requests by priority, so an status update doesn't need to wait for all
+    the avatars to be downloaded.
+
+    To avoid starvation, a request waiting more than <max_wait> seconds is
+    served before everything else, oldest first -- but only every other
+    request, so a backlog of old requests can't hold the interactive ones.
+    The None used to stop the workers is only delivered when there is no
+    more work.
+
+    Requests can also be added with a delay (e.g., retries); those only go
+    to their queues after the delay expires.
+
+    The queue holds at most <max_size> requests. When it's full, <policy>
+    decides what happens with a new one: BLOCK makes the caller wait (for
+    up to <block_timeout> seconds) for some room; DROP_OLDEST throws away
+    the oldest request of the least important class (as long as it isn't
+    more important than the new one); REJECT throws away the new request.
+    Every request also gets a deadline, <ttl> seconds (per class) after
+    it's queued. Requests thrown away or past their deadline are still
+    delivered to the workers, marked, so they can tell the callbacks
+    without going to the network."""
+
+    # request classes, from the most important to the least
+    (INTERACTIVE, TIMELINE, METADATA, MEDIA) = range(4)
+    names = ('interactive', 'timeline', 'metadata', 'media')
+
+    # what to do when the queue is full
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop-oldest'
+    REJECT = 'reject'
+    policies = (BLOCK, DROP_OLDEST, REJECT)
+
+    def __init__(self, max_wait=10, max_size=200, policy=DROP_OLDEST,
+            ttl=(300, 120, 120, 60), block_timeout=5):
+        """<max_size> can be None for an unbounded queue; <ttl> has one value
+        per class, in the same order as the classes (None for no
+        deadline.)"""
+        if policy not in self.policies:
+            raise ValueError('Unknown queue policy: %s' % (policy))
+
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self.policy = policy
+        self.ttl = ttl
+        self.block_timeout = block_timeout
+
+        self._queues = [deque() for name in self.names]
+        self._stop = deque()
+        self._shed = deque()        # requests thrown away, to be answered
+        self._delayed = []          # heap of (due, seq, priority, item)
+        self._seq = 0
+        self._promoted = False      # was the last request a starving one?
+        self._cond = threading.Condition()
+        self._log = logging.getLogger('mitterlib.threadhttp.scheduler')
+
+        self.dropped = 0
+        self.rejected = 0
+        self.expired = 0
+
+    def put(self, item, priority=MEDIA, delay=0, force=False):
+        """Add an item in the queue of the <priority> class. If <delay> is
+        set, the item only becomes available after that many seconds.
+        <force> ignores the size limit; it's used by the workers when putting
+        back a request they took from the queue (they can't block waiting
+        for themselves.)"""
+        self._cond.acquire()
+        try:
+            if item is None:
+                self._stop.append(None)
+                self._cond.notifyAll()
+                return
+
+            if item.deadline is None and self.ttl and \
+                    self.ttl[priority] is not None:
+                item.deadline = time.time() + self.ttl[priority]
+
+            if not force and not self._room(item, priority):
+                return
+
+            if delay > 0:
+                self._seq += 1
+                heapq.heappush(self._delayed, (time.time() + delay,
+                    self._seq, priority, item))
+            else:
+                self._queues[priority].append((time.time(), item))
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        return
+
+    def _full(self):
+        """True if the queue reached its size limit."""
+        return self.max_size is not None and \
+                self.pending() >= self.max_size
+
+    def _room(self, item, priority):
+        """Make room for <item> in the queue, following the policy. Returns
+        False if the item was thrown away instead. Must be called with the
+        lock held."""
+        if not self._full():
+            return True
+
+        if self.policy == self.BLOCK:
+            limit = time.time() + self.block_timeout
+            while self._full():
+                remaining = limit - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if not self._full():
+                return True
+        elif self.policy == self.DROP_OLDEST:
+            for victim in xrange(len(self._queues) - 1, priority - 1, -1):
+                queue = self._queues[victim]
+                if queue:
+                    self._log.info('Queue full, dropping a %s request' %
+                            (self.names[victim]))
+                    self.dropped += 1
+                    self._throw(queue.popleft()[1])
+                    return True
+
+        self._log.info('Queue full, rejecting a %s request' %
+                (self.names[priority]))
+        self.rejected += 1
+        self._throw(item)
+        return False
+
+    def _throw(self, item):
+        """Mark <item> as thrown away and leave it for the workers to answer.
+        Must be called with the lock held."""
+        item.dropped = True
+        self._shed.append(item)
+        self._cond.notifyAll()
+        return
+
+    def get(self, block=True, timeout=None):
+        """Return the next item to be processed, waiting for one if the queue
+        is empty. Like Queue.get(), raises Queue.Empty if <block> is False or
+        nothing arrives in <timeout> seconds."""
+        self._cond.acquire()
+        try:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while True:
+                now = time.time()
+                self._release_delayed(now)
+                if self._shed or self.qsize() or \
+                        (self._stop and not self._delayed):
+                    item = self._pop()
+                    # there may be someone waiting for room in the queue
+                    self._cond.notifyAll()
+                    return item
+
+                if not block:
+                    raise Queue.Empty
+
+                wait = None
+                if self._delayed:
+                    wait = self._delayed[0][0] - now
+                if timeout is not None:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise Queue.Empty
+                    if wait is None or remaining < wait:
+                        wait = remaining
+                self._cond.wait(wait)
+        finally:
+            self._cond.release()
+
+    def _release_delayed(self, now):
+        """Move the delayed items which are due to their queues. Must be
+        called with the lock held."""
+        while self._delayed and self._delayed[0][0] <= now:
+            (due, _, priority, item) = heapq.heappop(self._delayed)
+            self._queues[priority].append((due, item))
+        return
+
+    def _pop(self):
+        """Find the next item. Must be called with the lock held."""
+        if self._shed:
+            # those are answered right away, so get them out of the way
+            return self._shed.popleft()
+
+        now = time.time()
+        item = self._next(now)
+        if item is not None and item.expired(now):
+            self._log.info('Request to %s expired in the queue' % (item.url))
+            self.expired += 1
+        return item
+
+    def _next(self, now):
+        """Pick the next item by priority/age. Must be called with the lock
+        held."""
+        starving = None
+        if not self._promoted:
+            for queue in self._queues:
+                if queue and now - queue[0][0] > self.max_wait:
+                    if starving is None or queue[0][0] < starving[0][0]:
+                        starving = queue
+
+        if starving is not None:
+            self._log.debug('Request waiting for %.1fs, promoting it' %
+                    (now - starving[0][0]))
+            self._promoted = True
+            return starving.popleft()[1]
+
+        self._promoted = False
+
+        for queue in self._queues:
+            if queue:
+                return queue.popleft()[1]
+
+        return self._stop.popleft()
+
+    def qsize(self):
+        """Number of requests waiting to be processed."""
+        return sum([len(queue) for queue in self._queues])
+
+    def pending(self):
+        """Number of requests waiting, including the delayed ones."""
+        return self.qsize() + len(self._delayed)
+
+    def depth(self):
+        """Return the number of queued requests in each class."""
+        depth = {}
+        for (name, queue) in zip(self.names, self._queues):
+            depth[name] = len(queue)
+        depth['delayed'] = len(self._delayed)
+        return depth
+
+    def clear(self):
+        """Remove all the requests from the queue (but not the Nones used to
+        stop the workers) and return them."""
+        self._cond.acquire()
+        try:
+            items = list(self._shed)
+            self._shed.clear()
+            for queue in self._queues:
+                items.extend([item for (_, item) in queue])
+                queue.clear()
+            items.extend([item for (_, _, _, item) in self._delayed])
+            self._delayed = []
+            self._cond.notifyAll()
+            return items
+        finally:
+            self._cond.release()
+
+    def stats(self):
+        """Return the number of requests thrown away and why."""
+        return {
+                'dropped': self.dropped,
+                'rejected': self.rejected,
+                'expired': self.expired}
+
+
+class RetryPolicy(object):
+    """Decides if (and when) a failed request should be tried again. Only
+    idempotent requests are retried, waiting exponentially longer after each
+    failure, with some randomness so all the requests don't come back at the
+    same time."""
+
+    # network errors (the negative ThreadHTTP errors) and Twitter overload
+    RETRY_STATUS = (-1, -2, -3, -4, 500, 502, 503, 504)
+
+    def __init__(self, max_attempts=3, base_delay=2, max_delay=60):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._log = logging.getLogger('mitterlib.threadhttp.retry')
+
+        self.retries = 0
+        self.gave_up = 0
+
+    def delay(self, request, status):
+        """Return how many seconds to wait before trying the <request> again,
+        after it failed with <status>, or None if it shouldn't be tried
+        again."""
+        if status not in self.RETRY_STATUS or not request.idempotent():
+            return None
+
+        if request.attempts + 1 >= self.max_attempts:
+            self.gave_up += 1
+            self._log.info('Giving up on %s after %d attempts (status %s)' %
+                    (request.url, request.attempts + 1, status))
+            return None
+
+        backoff = min(self.max_delay, self.base_delay * 2 ** request.attempts)
+        delay = backoff / 2.0 + random.uniform(0, backoff / 2.0)
+
+        if request.expired(time.time() + delay):
+            # no point in waiting; it would expire before trying again
+            self.gave_up += 1
+            self._log.info('Not retrying %s, deadline is too close' %
+                    (request.url))
+            return None
+
+        self.retries += 1
+        self._log.info('Retrying %s in %.1fs (status %s, attempt %d)' %
+                (request.url, delay, status, request.attempts + 1))
+        return delay
+
+    def stats(self):
+        """Return the retry counters."""
+        return {
+                'retries': self.retries,
+                'gave_up': self.gave_up}
+
+
+class CircuitBreaker(object):
+    """Keeps track of the failures of each host. After <threshold> failures
+    in a row, the circuit "opens" and the requests for that host fail
+    immediately, without going to the network. After <reset_timeout>
+    seconds, a single request is allowed through ("half-open"); if it works,
+    the circuit closes again, otherwise it stays open for another
+    <reset_timeout> seconds."""
+
+    (CLOSED, OPEN, HALF_OPEN) = ('closed', 'open', 'half-open')
+
+    def __init__(self, threshold=5, reset_timeout=60):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self._hosts = {}    # host -> [state, failures, opened at, trying]
+        self._lock = threading.Lock()
+        self._log = logging.getLogger('mitterlib.threadhttp.breaker')
+
+        self.opened = 0
+        self.closed = 0
+        self.rejected = 0
+
+    def _change(self, host, circuit, state):
+        """Change the state of the <host> circuit. Must be called with the
+        lock held."""
+        self._log.info('Circuit for %s is now %s (was %s)' % (host, state,
+            circuit[0]))
+        circuit[0] = state
+        if state == self.OPEN:
+            self.opened += 1
+            circuit[2] = time.time()
+        elif state == self.CLOSED:
+            self.closed += 1
+        return
+
+    def allow(self, host):
+        """Return True if a request to <host> can go to the network."""
+        self._lock.acquire()
+        try:
+            circuit = self._hosts.get(host)
+            if circuit is None or circuit[0] == self.CLOSED:
+                return True
+
+            if circuit[0] == self.OPEN and \
+                    time.time() - circuit[2] >= self.reset_timeout:
+                self._change(host, circuit, self.HALF_OPEN)
+                circuit[3] = False
+
+            if circuit[0] == self.HALF_OPEN and not circuit[3]:
+                # our test request
+                circuit[3] = True
+                return True
+
+            self.rejected += 1
+            return False
+        finally:
+            self._lock.release()
+
+    def is_open(self, host):
+        """True if requests to <host> are being rejected."""
+        circuit = self._hosts.get(host)
+        return circuit is not None and circuit[0] != self.CLOSED
+
+    def record(self, host, failed):
+        """Record the result of a request to <host>."""
+        self._lock.acquire()
+        try:
+            circuit = self._hosts.setdefault(host, [self.CLOSED, 0, 0,
+                False])
+            circuit[3] = False
+            if not failed:
+                circuit[1] = 0
+                if circuit[0] != self.CLOSED:
+                    self._change(host, circuit, self.CLOSED)
+                return
+
+            circuit[1] += 1
+            if circuit[0] == self.HALF_OPEN or \
+                    (circuit[0] == self.CLOSED and
+                        circuit[1] >= self.threshold):
+                self._change(host, circuit, self.OPEN)
+        finally:
+            self._lock.release()
+        return
+
+    def release(self, host):
+        """A request to <host> ended without a result (it was cancelled);
+        if it was the test request of a half-open circuit, let another one
+        through. Doesn't count as a failure or a success."""
+        self._lock.acquire()
+        try:
+            circuit = self._hosts.get(host)
+            if circuit is not None:
+                circuit[3] = False
+        finally:
+            self._lock.release()
+        return
+
+    def stats(self):
+        """Return the breaker counters."""
+        return {
+                'opened': self.opened,
+                'closed': self.closed,
+                'rejected': self.rejected}
+
+
 class ThreadHTTP(threading.Thread):
     """Runs HTTP requests on threads."""
 
@@ -45,8 +1022,19 @@ class ThreadHTTP(threading.Thread):
     DNS_ERROR = -2
     INVALID_RESPONSE = -3
     LOW_LEVEL_ERROR = -4
+    CIRCUIT_OPEN = -5       # host is failing, request not even tried
+    EXPIRED = -6            # request waited too long in the queue
+    QUEUE_FULL = -7         # request thrown away, the queue was full
+    CANCELLED = -8          # request cancelled (callback is not called)
+
+    # how many redirects we follow before giving up
+    MAX_REDIRECTS = 5
 
-    def __init__(self, id, shared_queue=None):
+    # size of the blocks we read from the socket
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, id, shared_queue=None, pool=None, cache=None,
+            inflight=None, retry=None, breaker=None):
         threading.Thread.__init__(self)
         self.setDaemon(False)
         self._id = id
@@ -54,96 +1042,516 @@ class ThreadHTTP(threading.Thread):
         if shared_queue:
             self.queue = shared_queue
         else:
-            self.queue = Queue.Queue()
+            self.queue = RequestScheduler()
+
+        if pool:
+            self.pool = pool
+        else:
+            self.pool = ConnectionPool()
+
+        if cache:
+            self.cache = cache
+        else:
+            self.cache = ValidatorCache()
+
+        if inflight:
+            self.inflight = inflight
+        else:
+            self.inflight = InFlight()
+
+        if retry:
+            self.retry = retry
+        else:
+            self.retry = RetryPolicy()
+
+        if breaker:
+            self.breaker = breaker
+        else:
+            self.breaker = CircuitBreaker()
+
+        # bytes received from the network and after decompression
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+
+        # the request being processed and its connection, so it can be
+        # aborted from other threads
+        self._current = None
+        self._connection = None
+        self._aborted = False
+        self._abort_lock = threading.Lock()
 
     def request(self, callback, url, headers=None, body=None, jsonify=True,
-            *args, **kwargs):
+            cache=False, priority=RequestScheduler.MEDIA, *args, **kwargs):
         """Add a HTTP request to <server>, requesting <resource> in the queue
         pool. Once finished, call <callback>. Headers are optional. If there
         is <body>, do a POST request; otherwise, GET. <callback> must accept
         status, data and error (which can be None). If <jsonify> is True (the
         default), then convert the data to JSON before sending it to
-        <callback>."""
+        <callback>. <jsonify> can also be a function: if the response is a
+        JSON array, its elements are decoded while the response arrives and
+        given to the function, and <callback> receives the list of what the
+        function returned (the function may be called again for the same
+        elements if the request is retried). If <cache> is True, the request
+        is made conditional on the last response for the same URL; in this
+        case, <callback> may receive the same object twice, so it must not
+        change it. <cache> can also be an object with the same interface as
+        ValidatorCache, used instead of the shared one. <priority> is one of
+        the RequestScheduler classes.
 
-        url = urllib.quote(url.encode('utf-8'), '/:?=')
-        self.queue.put((callback, url, headers, body, jsonify, args, kwargs))
+        A GET identical to one already queued or running is not requested
+        again; <callback> is called with the result of the first one (if
+        <jsonify> is a function, it is not called again: <callback> gets its
+        own list, but the elements in it are shared with the first one.)
 
-    def make_request(self, url, headers, body):
-        """Make the actual request to the server."""
-        request = urllib2.Request(url=url)
+        Returns the Request, which can be used to cancel it."""
+
+        # Only characters that can't appear in a URL are quoted; the
+        # reserved ones and '%' are kept, so URLs that arrive already
+        # encoded (like the ones built by Twitter.request) are not changed.
+        url = urllib.quote(url.encode('utf-8'), "/:?=&%#;+,@!$'()*~[]")
+        request = Request(callback, url, headers, body, jsonify, cache,
+                priority, args, kwargs)
+        if self.inflight.join(request):
+            self._log.debug('Request of %s merged with the one in flight' %
+                    (url))
+            return request
+
+        self.queue.put(request, priority)
+        return request
+
+    def cancel_all(self):
+        """Cancel the request being processed by this worker."""
+        request = self._current
+        if request:
+            request.cancel()
+        return
+
+    def _abort(self, request):
+        """Called (from any thread) when <request> is cancelled while
+        running: drop the connection, so the worker stops waiting for the
+        server."""
+        self._abort_lock.acquire()
+        try:
+            if request is not self._current or \
+                    self.inflight.wanted(request):
+                return
+            self._log.debug('Aborting request of %s' % (request.url))
+            self._aborted = True
+            conn = self._connection
+            if conn and conn.sock:
+                try:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except error:
+                    pass
+        finally:
+            self._abort_lock.release()
+        return
+
+    def _running(self, request):
+        """Set (or clear, if <request> is None) the request being processed
+        by this worker."""
+        self._abort_lock.acquire()
+        try:
+            if self._current:
+                self._current.abort = None
+            self._current = request
+            self._connection = None
+            self._aborted = False
+            if request:
+                request.started()
+                request.abort = self._abort
+        finally:
+            self._abort_lock.release()
+        return
+
+    def close_connections(self):
+        """Close the idle connections kept for reuse."""
+        self.pool.clear()
+        return
+
+    def _split(self, url):
+        """Split the <url> in scheme, host, port (None for the default port)
+        and the path (including the query string) to be requested."""
+        (scheme, netloc, path, query, _) = urlparse.urlsplit(url)
+        if ':' in netloc:
+            (host, port) = netloc.rsplit(':', 1)
+            port = int(port)
+        else:
+            host = netloc
+            port = None
+        if not path:
+            path = '/'
+        if query:
+            path = '%s?%s' % (path, query)
+        return (scheme, host, port, path)
+
+    def _request_headers(self, headers, body):
+        """Return the headers to be sent to the server, including the ones
+        we add to every request."""
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', 'gzip, deflate')
         if body:
             self._log.debug('Body: %s' % (body))
-            request.add_data(body)
+            headers.setdefault('Content-Type',
+                    'application/x-www-form-urlencoded')
 
         for key in headers:
             self._log.debug('Header: %s=%s' % (key, headers[key]))
-            request.add_header(key, headers[key])
+        return headers
+
+    def _send(self, url, headers, body):
+        """Send the request using one of the pooled connections and return
+        the response object (already read), with its body in the "data"
+        attribute. If the pooled connection was closed by the server while
+        idle, a GET is tried again with a fresh connection; a POST is not,
+        since the server may have applied it already."""
+        (scheme, host, port, path) = self._split(url)
+
+        if body:
+            method = 'POST'
+        else:
+            method = 'GET'
+
+        while True:
+            (conn, reused) = self.pool.get(scheme, host, port)
+            self._connection = conn
+            stale = False
+            try:
+                if self._aborted:
+                    raise error('Request aborted')
+                try:
+                    conn.request(method, path, body, headers)
+                    response = conn.getresponse()
+                except socket.timeout:
+                    # the server is slow, not gone; trying again would only
+                    # make us wait all over again
+                    raise
+                except BadStatusLine, exc:
+                    # garbage in the status line is a response; nothing at
+                    # all means the connection was closed
+                    stale = exc.line in ('', "''") or \
+                            exc.line.startswith('No status line')
+                    raise
+                except error:
+                    stale = True
+                    raise
+                self._read(response)
+            except:
+                self.pool.discard(conn)
+                if stale and reused and method == 'GET' and \
+                        not self._aborted:
+                    # server dropped the idle connection; not a real error
+                    self._log.debug('Stale connection, trying again')
+                    continue
+                raise
+
+            if response.will_close:
+                self.pool.discard(conn)
+            else:
+                self.pool.put(scheme, host, port, conn)
+            return response
+
+    def _read(self, response):
+        """Read the response body, decompressing it if needed. The body is
+        stored in the "data" attribute of the response; the number of bytes
+        received and the size after decompression go in "compressed_size"
+        and "size"."""
+        encoding = (response.getheader('content-encoding') or '').lower()
+        if encoding in ('gzip', 'x-gzip'):
+            decoder = Decoder('gzip')
+        elif encoding == 'deflate':
+            decoder = Decoder('deflate')
+        else:
+            decoder = None
+
+        # statuses are decoded while they arrive, if the request wants
+        response.stream = None
+        request = self._current
+        if request and callable(request.jsonify) and response.status == 200:
+            response.stream = JSONStream(request.jsonify)
+            add = response.stream.feed
+        else:
+            parts = []
+            add = parts.append
+
+        received = 0
+        while True:
+            if self._aborted:
+                raise error('Request aborted')
+            chunk = response.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            received += len(chunk)
+            if decoder:
+                chunk = decoder.decompress(chunk)
+            add(chunk)
+
+        if decoder:
+            add(decoder.flush())
+
+        if response.stream:
+            response.data = response.stream.data()
+            response.size = response.stream.size
+        else:
+            response.data = ''.join(parts)
+            response.size = len(response.data)
+        response.compressed_size = received
+
+        self.bytes_received += received
+        self.bytes_decoded += response.size
+        if decoder:
+            self._log.debug('Received %d bytes (%d uncompressed)' %
+                    (received, response.size))
+        return
+
+    def make_request(self, url, headers, body):
+        """Make the actual request to the server."""
+        (status, data, _) = self._fetch(url, headers, body)
+        return (status, data)
+
+    def _fetch(self, url, headers, body):
+        """Make the request to the server and return the status, the data
+        and the response object (which is None if there was no response at
+        all.)"""
+        headers = self._request_headers(headers, body)
 
         try:
             self._log.debug('Starting request of %s' % (url))
-            response = urllib2.urlopen(request)
-            data = response.read()
-        except urllib2.HTTPError, exc:
-            self._log.debug('HTTPError: %d' % (exc.code))
-            self._log.debug('HTTPError: response body:\n%s'
-                                    % exc.read())
-            return (exc.code, None)
-        except urllib2.URLError, exc:
-            self._log.error('URL error: %s' % exc.reason)
-            return (ThreadHTTP.DNS_ERROR, None)
+            redirects = 0
+            while True:
+                response = self._send(url, headers, body)
+                location = response.getheader('location')
+                if response.status not in (301, 302, 303, 307) or \
+                        not location or redirects >= self.MAX_REDIRECTS:
+                    break
+
+                # same as urllib2: follow the redirect, dropping the body
+                redirects += 1
+                url = urlparse.urljoin(url, location)
+                self._log.debug('Redirected to %s' % (url))
+                if response.status != 307:
+                    body = None
+                    headers.pop('Content-Type', None)
+        except socket.gaierror, exc:
+            self._log.error('DNS error: %s' % (exc))
+            return (ThreadHTTP.DNS_ERROR, None, None)
+        except zlib.error, exc:
+            self._log.error('Invalid compressed data: %s' % (exc))
+            return (ThreadHTTP.INVALID_RESPONSE, None, None)
         except BadStatusLine:
             self._log.error('Bad status line (Twitter is going bananas)')
-            return (ThreadHTTP.INVALID_RESPONSE, None)
+            return (ThreadHTTP.INVALID_RESPONSE, None, None)
+        except httplib.HTTPException, exc:
+            self._log.error('Invalid response: %s' % (exc))
+            return (ThreadHTTP.INVALID_RESPONSE, None, None)
         except error:   # That's the worst exception ever.
             self._log.error('Socket connection error')
-            return (ThreadHTTP.LOW_LEVEL_ERROR, None)
+            return (ThreadHTTP.LOW_LEVEL_ERROR, None, None)
+
+        if response.status < 200 or response.status >= 300:
+            self._log.debug('HTTPError: %d' % (response.status))
+            self._log.debug('HTTPError: response body:\n%s'
+                                    % response.data)
+            return (response.status, None, response)
 
         self._log.debug('Request completed')
 
-        return (None, data)
+        return (None, response.data, response)
+
+    def _prepare(self, request):
+        """Return the headers for the <request> and the cached entry for it,
+        if the request is a conditional one."""
+        headers = request.headers
+
+        cached = None
+        cache = self._cache_for(request)
+        if cache:
+            cached = cache.get(request.url)
+            if cached:
+                headers = dict(headers or {})
+                headers.update(cache.headers(cached))
+        return (headers, cached)
+
+    def _cache_for(self, request):
+        """Return the cache to be used for <request>: the shared one if its
+        "cache" is True, the one given in the request or None if the request
+        isn't cached."""
+        if not request.cache or not request.idempotent():
+            return None
+        if request.cache is True:
+            return self.cache
+        return request.cache
+
+    def _allowed(self, request):
+        """Check if the <request> should go to the network: someone still
+        wants it, it's not thrown away by the queue, not past its deadline
+        and the host isn't failing (per the circuit breaker.) If not, finish
+        the request right away."""
+        if not self.inflight.wanted(request):
+            self._log.debug('Request of %s cancelled' % (request.url))
+            self._complete(request, None, self.CANCELLED, None, None)
+            return False
+
+        if request.dropped:
+            self._log.debug('Queue was full, not requesting %s' %
+                    (request.url))
+            self._complete(request, None, self.QUEUE_FULL, None, None)
+            return False
+
+        if request.expired():
+            self._log.debug('Deadline passed, not requesting %s' %
+                    (request.url))
+            self._complete(request, None, self.EXPIRED, None, None)
+            return False
+
+        if self.breaker.allow(request.host):
+            return True
+
+        self._log.debug('Circuit open for %s, not requesting %s' %
+                (request.host, request.url))
+        self._complete(request, None, self.CIRCUIT_OPEN, None, None)
+        return False
+
+    def _result(self, request, cached, status, data, response):
+        """Got a result for the <request>; record it in the breaker and
+        either schedule a retry or complete it."""
+        if not self.inflight.wanted(request):
+            # cancelled while running; whatever happened doesn't matter
+            self.breaker.release(request.host)
+            self._complete(request, None, self.CANCELLED, None, None)
+            return
+
+        failed = status in RetryPolicy.RETRY_STATUS
+        self.breaker.record(request.host, failed)
+
+        if failed and not self.breaker.is_open(request.host):
+            delay = self.retry.delay(request, status)
+            if delay is not None:
+                request.attempts += 1
+                self.queue.put(request, request.priority, delay, force=True)
+                return
+
+        self._complete(request, cached, status, data, response)
+        return
+
+    def _decode(self, data):
+        """Convert the <data> received from the server to JSON. Returns the
+        status (None if everything went fine) and the converted data."""
+        # Hack to fix invalid JSON from Twitter
+        data = re.sub("Couldn't find Status with ID=([0-9]*),", '', \
+            data)
+        try:
+            if hasattr(json, "loads"):
+                # JSON 1.9 keeps complaining to use load instead of
+                # read
+                return (None, json.loads(data))
+            else:
+                # JSON 1.7 still uses read
+                return (None, json.read(data))
+        except Exception, e:
+            self._log.error('Exception while parsing json. %s' % e)
+            if 'HTTP-EQUIV="REFRESH"' in data:
+                # Twitter has this annoying habit of returning a
+                # 'please refresh' meta with a 200 HTTP Status instead
+                # of using a 503 status as mentioned in their API docs
+                status = 503
+            else:
+                status = str(e)
+            print data
+            return (status, None)
+
+    def _deliver(self, request, data, status):
+        """Finish the <request> and call its callback, unless the request was
+        cancelled."""
+        request.finished(status)
+        if request.cancelled():
+            return
+        request.callback(data, status, *request.args, **request.kwargs)
+        return
+
+    def _complete(self, request, cached, status, data, response):
+        """Process the result of the <request> (converting it to JSON, if
+        requested) and call its callback, and the callbacks of all the
+        identical requests merged with it."""
+        callback = request.callback
+        jsonify = request.jsonify
+        cache = self._cache_for(request)
+        url = request.url
+        waiters = self.inflight.finish(request)
+
+        if cached and status == 304:
+            self._log.debug('Not modified, using cached data')
+            cache.hits += 1
+            cache.touch(url)
+            # cached data is shared anyway
+            for each in [request] + waiters:
+                self._deliver(each, cached[2], None)
+            return
+        elif cache:
+            cache.misses += 1
+
+        if response:
+            size = response.size
+            stream = response.stream
+        else:
+            size = 0
+            stream = None
+        streamed = stream and stream.array and not status
+        raw = data
+        if streamed:
+            # already decoded while it was received
+            (status, data) = stream.result()
+        elif (not data) or (status and status != 200):
+            self._log.info('Got HTTP Status %s from twitter.com' % status)
+            self._log.debug('Request failed for callback handler: %s' %
+                                        callback.__name__)
+        elif jsonify:
+            (status, data) = self._decode(data)
+
+        if cache and data is not None and not status:
+            cache.put(url, response.getheader('etag'),
+                    response.getheader('last-modified'), data, size)
+
+        # that None there is the error response. Sorry, not implemented
+        # yet (but I'll do it, I promise.)
+
+        self._deliver(request, data, status)
+
+        for waiter in waiters:
+            if jsonify and not cache and data is not None and \
+                    not waiter.cancelled():
+                # the callbacks are free to change the data they receive, so
+                # each one gets its own copy (decoding it again is faster
+                # than a deepcopy.) A streamed array was converted only once,
+                # while it arrived: each waiter gets its own list, but the
+                # items in it are shared and must not be changed. The
+                # per-item hooks of <jsonify> are not called again either,
+                # but requests with different converters are never merged
+                # (see InFlight._key), so the waiters have no hooks of
+                # their own.
+                if streamed:
+                    data = list(data)
+                else:
+                    (status, data) = self._decode(raw)
+            self._deliver(waiter, data, status)
+        return
 
     def run(self):
         """Do the request to the server."""
         while 1:
             self._log.debug('Thread %d waiting for work' % (self._id))
-            work = self.queue.get()
-            if work is None:
+            request = self.queue.get()
+            if request is None:
                 self._log.debug('Thread %d done' % (self._id))
                 break
 
-            (callback, url, headers, body, jsonify, args, kwargs) = work
-            (status, data) = self.make_request(url, headers, body)
-
-            if (not data) or (status and status != 200):
-                self._log.info('Got HTTP Status %s from twitter.com' % status)
-                self._log.debug('Request failed for callback handler: %s' %
-                                            callback.__name__)
-            elif jsonify:
-                # Hack to fix invalid JSON from Twitter
-                data = re.sub("Couldn't find Status with ID=([0-9]*),", '', \
-                    data)
-                try:
-                    if hasattr(json, "loads"):
-                        # JSON 1.9 keeps complaining to use load instead of
-                        # read
-                        data = json.loads(data)
-                    else:
-                        # JSON 1.7 still uses read
-                        data = json.read(data)
-                except Exception, e:
-                    self._log.error('Exception while parsing json. %s' % e)
-                    if 'HTTP-EQUIV="REFRESH"' in data:
-                        # Twitter has this annoying habit of returning a
-                        # 'please refresh' meta with a 200 HTTP Status instead
-                        # of using a 503 status as mentioned in their API docs
-                        status = 503
-                    else:
-                        status = str(e)
-                    print data
-                    data = None
-
-            # that None there is the error response. Sorry, not implemented
-            # yet (but I'll do it, I promise.)
-
-            callback(data, status, *args, **kwargs)
+            if not self._allowed(request):
+                continue
+
+            self._running(request)
+            (headers, cached) = self._prepare(request)
+            (status, data, response) = self._fetch(request.url, headers,
+                    request.body)
+            self._running(None)
+            self._result(request, cached, status, data, response)
         return
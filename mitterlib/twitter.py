@@ -22,31 +22,185 @@ import urllib2
 import logging
 import datetime
 import threadhttp
-import Queue
+import asynchttp
 import base64
+import threading
+import weakref
 
 from constants import version
+from threadhttp import RequestScheduler
+
+
+_months = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+        'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+
+# looking up the two digit numbers is a lot faster than int()
+_numbers = dict([('%02d' % (number), number) for number in xrange(100)])
+
+# the same statuses come again and again, so we keep the dates we already
+# converted
+_datetimes = {}
+_DATETIMES_SIZE = 5000
+
+
+def _utc(date, offset):
+    """Convert <date>, in the timezone with <offset> ('+hhmm' or '-hhmm'),
+    to UTC."""
+    if offset == '+0000':
+        return date
+
+    minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+    if offset[0] == '-':
+        minutes = -minutes
+    return date - datetime.timedelta(minutes=minutes)
+
+
+def _parse_datetime(server_str):
+    """Convert a date in the format used by the server, but with fields of
+    any size, to a datetime object (in UTC)."""
+    (_, month, day, time_info, offset, year) = server_str.split()
+    (hour, minute, second) = time_info.split(':')
+
+    date = datetime.datetime(int(year), _months[month], int(day),
+            int(hour), int(minute), int(second))
+    return _utc(date, offset)
 
 
 def _to_datetime(server_str):
-    """Convert a date send by the server to a datetime object.
+    """Convert a date send by the server to a datetime object (in UTC).
     Ex:
         from this:
             Tue Mar 13 00:12:41 +0000 2007
             to datetime.
     """
-    month_names = [None, 'Jan', 'Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec']
-    date_info = server_str.split(' ')
-    month = month_names.index(date_info[1])
-    day = int(date_info[2])
-    year = int(date_info[5])
-
-    time_info = date_info[3].split(':')
-    hour = int(time_info[0])
-    minute = int(time_info[1])
-    second = int(time_info[2])
-
-    return datetime.datetime(year, month, day, hour, minute, second)
+    date = _datetimes.get(server_str)
+    if date is not None:
+        return date
+
+    try:
+        # all the fields have a fixed size, so we just cut them off
+        date = datetime.datetime(int(server_str[26:]),
+                _months[server_str[4:7]], _numbers[server_str[8:10]],
+                _numbers[server_str[11:13]], _numbers[server_str[14:16]],
+                _numbers[server_str[17:19]])
+        date = _utc(date, server_str[20:25])
+    except (KeyError, ValueError):
+        # not quite the format we expected
+        date = _parse_datetime(server_str)
+
+    if len(_datetimes) >= _DATETIMES_SIZE:
+        _datetimes.clear()
+    _datetimes[server_str] = date
+    return date
+
+
+class _Record(object):
+    """Base for the records. Besides the attributes, the fields can be read
+    like the keys of the dictionaries we get from Twitter, so the code which
+    expects those keeps working; as_dict() returns a real dictionary."""
+
+    __slots__ = ()
+    _fields = ()
+
+    def __getitem__(self, key):
+        if key not in self._fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self._fields:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def get(self, key, default=None):
+        if key not in self._fields:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return list(self._fields)
+
+    def as_dict(self):
+        """Return the record as a dictionary."""
+        result = {}
+        for field in self._fields:
+            value = getattr(self, field)
+            if isinstance(value, _Record):
+                value = value.as_dict()
+            result[field] = value
+        return result
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.as_dict())
+
+
+class User(_Record):
+    """A Twitter user, with only the fields Mitter uses. Use User.shared()
+    to build them, so all the statuses of a user share the same object."""
+
+    __slots__ = ('id', 'name', 'screen_name', 'profile_image_url',
+            '__weakref__')
+    _fields = ('id', 'name', 'screen_name', 'profile_image_url')
+
+    # id -> User, while some status uses it
+    _shared = weakref.WeakValueDictionary()
+    _shared_lock = threading.Lock()
+
+    def __init__(self, id, name, screen_name, profile_image_url):
+        self.id = id
+        self.name = name
+        self.screen_name = screen_name
+        self.profile_image_url = profile_image_url
+
+    @classmethod
+    def shared(cls, data):
+        """Return the User for the <data> dictionary, reusing the object we
+        already have for the user (which is updated if the user changed
+        something.) Users are identified by the id or, if the data doesn't
+        have it, by the screen name."""
+        key = data.get('id') or data['screen_name']
+        cls._shared_lock.acquire()
+        try:
+            user = cls._shared.get(key)
+            if user is None:
+                user = cls(data.get('id'), data['name'], data['screen_name'],
+                        data['profile_image_url'])
+                cls._shared[key] = user
+            else:
+                user.name = data['name']
+                user.screen_name = data['screen_name']
+                user.profile_image_url = data['profile_image_url']
+        finally:
+            cls._shared_lock.release()
+        return user
+
+
+class Status(_Record):
+    """A status, with only the fields Mitter uses. <created_at> is a datetime
+    (in UTC) and <user> is a User."""
+
+    __slots__ = ('id', 'text', 'created_at', 'in_reply_to_status_id',
+            'user')
+    _fields = __slots__
+
+    def __init__(self, id, text, created_at, in_reply_to_status_id, user):
+        self.id = id
+        self.text = text
+        self.created_at = created_at
+        self.in_reply_to_status_id = in_reply_to_status_id
+        self.user = user
+
+    @classmethod
+    def from_json(cls, data):
+        """Build the Status from the <data> dictionary sent by Twitter; the
+        dictionary can be thrown away after this."""
+        return cls(int(data['id']), urllib2.unquote(data['text']),
+                _to_datetime(data['created_at']),
+                data.get('in_reply_to_status_id'),
+                User.shared(data['user']))
 
 
 class Twitter(object):
@@ -59,23 +213,68 @@ class Twitter(object):
     UNKNOWN_ERROR = -1
     LIMIT_EXCEEDED = 1
 
-    def __init__(self, username, password, https=False, threads=2):
-        """Class initialization."""
+    # statuses in a page of a timeline, and how many statuses we request to
+    # fill the gap between the ones we had and the new ones (see
+    # _update_fields)
+    PAGE_SIZE = 20
+    MAX_GAP = 200
+
+    def __init__(self, username, password, https=False, threads=2,
+            engine='thread', concurrency=16, queue_size=200,
+            queue_policy=RequestScheduler.DROP_OLDEST, max_backfills=1):
+        """Class initialization. <engine> selects how the requests are
+        processed: 'thread' uses <threads> ThreadHTTP workers; 'async' uses
+        a single AsyncHTTP event loop with up to <concurrency> requests in
+        flight. In both cases, if <threads> is 1, no threads are used at
+        all. <queue_size> and <queue_policy> control what happens when the
+        requests come faster than they can be processed (see
+        RequestScheduler.) <max_backfills> is the number of requests for
+        older statuses (see backfill()) that can be pending at the same
+        time."""
 
         self.username = username
         self.password = password
         self.https = https
 
-        self.queue = Queue.Queue()
+        self.queue = RequestScheduler(max_size=queue_size,
+                policy=queue_policy)
         self.log = logging.getLogger('mitterlib.twitter')
 
-        self.workers = []
+        # all workers share the same keep-alive connections
+        self.pool = threadhttp.ConnectionPool()
+        self.cache = threadhttp.ValidatorCache()
+        self.inflight = threadhttp.InFlight()
+        self.retry = threadhttp.RetryPolicy()
+        self.breaker = threadhttp.CircuitBreaker()
+
+        # newest status id we've seen in each timeline, so the next request
+        # only brings the statuses we don't have yet.
+        self.since_ids = {}
 
-        if threads > 1:
+        # pending requests for older statuses, (timeline, max_id, page) ->
+        # request handle
+        self.max_backfills = max_backfills
+        self.backfills = {}
+        self._backfills_lock = threading.RLock()
+
+        self.workers = []
+        self.threaded = threads > 1
+
+        if engine == 'async':
+            # the event loop does everything in a single thread
+            worker = asynchttp.AsyncHTTP(0, self.queue, self.cache,
+                    self.inflight, self.retry, self.breaker, concurrency)
+            if self.threaded:
+                self.log.debug('Starting async engine')
+                worker.start()
+            self.workers.append(worker)
+        elif self.threaded:
             while threads > 0:
                 self.log.debug('Starting worker %s' % (threads))
 
-                worker = threadhttp.ThreadHTTP(threads, self.queue)
+                worker = threadhttp.ThreadHTTP(threads, self.queue,
+                        self.pool, self.cache, self.inflight, self.retry,
+                        self.breaker)
                 worker.start()
 
                 self.workers.append(worker)
@@ -83,7 +282,8 @@ class Twitter(object):
         else:
             # with just one thread, we don't used threads at all. System will
             # work in a non-threaded way.
-            worker = threadhttp.ThreadHTTP(0, self.queue)
+            worker = threadhttp.ThreadHTTP(0, self.queue, self.pool,
+                    self.cache, self.inflight, self.retry, self.breaker)
             # no start
             self.workers.append(worker)
 
@@ -118,12 +318,30 @@ class Twitter(object):
                 'User-Agent': self._user_agent}
         return headers
 
-    def request(self, resource, callback, headers=None, body=None, *args,
+    def request(self, resource, callback, headers=None, body=None,
+            params=None, cache=False, priority=None, jsonify=True, *args,
             **kwargs):
         """Send a request to the Twitter server. Once finished, call the
-        function at callback."""
+        function at callback. <params> is a dictionary of values to be added
+        in the query string. If <cache> is True, the request is conditional
+        and, if nothing changed, callback receives the same data as the last
+        time (so it shouldn't change it.) <priority> is one of the
+        RequestScheduler classes; by default, POSTs are interactive and
+        everything else is metadata. <jsonify> is passed to the worker (see
+        ThreadHTTP.request.)
+
+        Returns the request handle (threadhttp.Request), which can be used to
+        cancel it or check its status."""
+
+        if priority is None:
+            if body:
+                priority = RequestScheduler.INTERACTIVE
+            else:
+                priority = RequestScheduler.METADATA
 
         url = '%s%s.json' % (self._server, resource)
+        if params:
+            url = '%s?%s' % (url, urllib.urlencode(params))
         self.log.debug('Request to %s' % (url))
 
         request_headers = self._common_headers()
@@ -135,24 +353,38 @@ class Twitter(object):
         # And yes, I know this is fugly.
 
         worker = self.workers[0]
-        worker.request(callback, url, request_headers, body, True, *args,
-                **kwargs)
+        handle = worker.request(callback, url, request_headers, body,
+                jsonify, cache, priority, *args, **kwargs)
 
-        if len(self.workers) == 1:
+        if not self.threaded:
             # no threads, rememeber?
             self.queue.put(None)    # so it quits the loop
             worker.run()
-        return
+        return handle
 
-    def close(self):
-        """Close the connection with Twitter."""
+    def close(self, abort=False):
+        """Close the connection with Twitter. If <abort> is True, all the
+        pending requests are cancelled (their callbacks are not called)
+        instead of waiting for them to finish."""
         # Internally, what we do is fill the Queue pool with Nones, so the
         # working threads stop and close.
 
-        if len(self.workers) == 1:
-            # no threads, so we just return
+        if not self.threaded:
+            # no threads, so we just close the idle connections
+            self.workers[0].close_connections()
             return
 
+        if abort:
+            self.log.debug('Cancelling all requests')
+            for request in self.queue.clear():
+                request.cancel()
+                self.inflight.finish(request)
+            # the ones merged with a running request aren't in the queue,
+            # but the running request would go on for them
+            self.inflight.cancel_all()
+            for worker in self.workers:
+                worker.cancel_all()
+
         for a in xrange(len(self.workers)):
             self.log.debug('Adding NONE for the workers')
             self.queue.put(None)
@@ -163,28 +395,162 @@ class Twitter(object):
         for worker in self.workers:
             worker.join()
 
-    def friends_timeline(self, callback, *args, **kwargs):
-        """Retrieve the logged user friends timeline."""
+        # the pool is shared, so closing it in any worker is enough
+        self.workers[0].close_connections()
+
+    def set_since_id(self, timeline, since_id):
+        """Set the newest status id already known for <timeline>
+        ('friends_timeline' or 'replies'), e.g., one saved from a previous
+        run."""
+        if since_id:
+            self.since_ids[timeline] = int(since_id)
+        else:
+            self.since_ids.pop(timeline, None)
+        return
+
+    def reset_since_ids(self):
+        """Forget the seen statuses, so the next requests bring full pages
+        again (e.g., when the user changes.)"""
+        self.since_ids = {}
+        return
+
+    def _converter(self, stream):
+        """Return the function which converts each status of a timeline to a
+        Status while the response arrives, also passing it to <stream>, if
+        set."""
+        if stream is None:
+            return Status.from_json
+
+        def convert(data):
+            status = Status.from_json(data)
+            stream(status)
+            return status
+        return convert
+
+    def _timeline(self, timeline, callback, incremental, stream, *args,
+            **kwargs):
+        """Request one of the timelines. If <incremental> is True, only
+        statuses newer than the ones we already saw are requested. If
+        <stream> is set, it is called (in the worker thread) with each Status
+        as soon as it arrives, before <callback> gets all of them."""
+        params = None
+        since_id = self.since_ids.get(timeline)
+        if incremental and since_id:
+            params = {'since_id': since_id}
+        else:
+            since_id = None
 
         # because we want to make a nice dictionary for our users, we DON'T
         # call their callback; we set a callback inside this object which will
         # convert the 'created_at' field to a datetime and THEN call their
         # callback.
 
-        self.request('/statuses/friends_timeline', self._update_fields,
-                user_callback=callback, *args, **kwargs)
+        return self.request('/statuses/%s' % (timeline),
+                self._update_fields, params=params,
+                priority=RequestScheduler.TIMELINE,
+                jsonify=self._converter(stream), user_callback=callback,
+                timeline=timeline, since_id=since_id, stream=stream, *args,
+                **kwargs)
+
+    def backfill(self, timeline, callback, max_id=None, page=None,
+            stream=None, *args, **kwargs):
+        """Request a page of older statuses of <timeline> ('friends_timeline'
+        or 'replies'): the ones older than the status <max_id> or, if
+        <max_id> is not set, the page number <page>. The callback receives
+        the statuses like the ones from friends_timeline (and <stream> works
+        the same way), but the statuses don't count as seen for the
+        incremental requests.
+
+        Asking again for the same page while the request is pending returns
+        the pending request; if there are already max_backfills requests
+        pending, nothing is requested and None is returned. Otherwise,
+        returns the request handle."""
+        if max_id:
+            max_id = int(max_id)
+        key = (timeline, max_id, page)
+
+        self._backfills_lock.acquire()
+        try:
+            # forget the ones which finished or were cancelled
+            for (pending, handle) in self.backfills.items():
+                if handle.state in (handle.DONE, handle.CANCELLED):
+                    del self.backfills[pending]
+
+            if key in self.backfills:
+                self.log.debug('Backfill %s is already pending' % (str(key)))
+                return self.backfills[key]
+
+            if len(self.backfills) >= self.max_backfills:
+                self.log.debug('Too many backfills, ignoring %s' %
+                        (str(key)))
+                return None
+
+            params = {}
+            if max_id:
+                # Twitter returns the status with max_id too, which we
+                # already have
+                params['max_id'] = max_id - 1
+            elif page:
+                params['page'] = page
+
+            handle = self.request('/statuses/%s' % (timeline),
+                    self._backfilled, params=params,
+                    priority=RequestScheduler.TIMELINE,
+                    jsonify=self._converter(stream), user_callback=callback,
+                    backfill_key=key, *args, **kwargs)
+            if handle.state not in (handle.DONE, handle.CANCELLED):
+                self.backfills[key] = handle
+        finally:
+            self._backfills_lock.release()
+
+        return handle
+
+    def _backfilled(self, data, error=None, backfill_key=None, *args,
+            **kwargs):
+        """Called when a backfill request finishes. Frees its slot and
+        converts the fields like _update_fields, but without touching the
+        since_ids."""
+        self._backfills_lock.acquire()
+        self.backfills.pop(backfill_key, None)
+        self._backfills_lock.release()
+
+        self._update_fields(data, error, *args, **kwargs)
         return
 
-    def _update_fields(self, data, error=None, user_callback=None,
+    def friends_timeline(self, callback, incremental=True, stream=None,
             *args, **kwargs):
+        """Retrieve the logged user friends timeline. Unless <incremental> is
+        False, only the statuses newer than the last request are
+        retrieved. <stream> receives each status as soon as it arrives (see
+        _timeline.)"""
+        return self._timeline('friends_timeline', callback, incremental,
+                stream, *args, **kwargs)
+
+    def _update_fields(self, data, error=None, user_callback=None,
+            timeline=None, since_id=None, stream=None, received=None, *args,
+            **kwargs):
         """Called after we do a friends timeline request. We use it to convert
-        the 'created_at' field to a datetime and convert HTML chars in the
-        body."""
+        the statuses to Status objects (with the 'created_at' field as a
+        datetime and the HTML chars in the body converted.)
+
+        If the request was for the statuses after <since_id> and it brought a
+        full page, there may be more statuses between that page and the ones
+        we had (e.g., Mitter was closed for a while); the next pages are
+        requested (up to MAX_GAP statuses) before calling <user_callback>
+        with all of them. <received> has the statuses of the pages before
+        this one."""
 
         if user_callback is None:
             self.log.debug('User_callback not set')
             return
 
+        if received and (error or 'error' in data):
+            # the pages we got are still good, but the gap is still open;
+            # the since_id stays, so the next request tries again
+            self.log.debug('Error filling the gap in %s' % (timeline))
+            user_callback(received, None, *args, **kwargs)
+            return
+
         if error:
             # do not try to convert the data if there was any error in the
             # connection
@@ -203,15 +569,34 @@ class Twitter(object):
             user_callback([], error, *args, **kwargs)
             return
 
+        # we only keep what we use of each status (usually, it was already
+        # done while the statuses arrived)
+        data = [tweet if isinstance(tweet, Status) else
+                Status.from_json(tweet) for tweet in data]
+
+        page = data
+        data = (received or []) + page
+        if since_id and len(page) >= self.PAGE_SIZE:
+            oldest = min([tweet.id for tweet in page])
+            if oldest - 1 > since_id and len(data) < self.MAX_GAP:
+                self.log.debug('Filling the gap in %s below %d' %
+                        (timeline, oldest))
+                self.request('/statuses/%s' % (timeline),
+                        self._update_fields,
+                        params={'since_id': since_id, 'max_id': oldest - 1},
+                        priority=RequestScheduler.TIMELINE,
+                        jsonify=self._converter(stream),
+                        user_callback=user_callback, timeline=timeline,
+                        since_id=since_id, stream=stream, received=data,
+                        *args, **kwargs)
+                return
+
+        newest = self.since_ids.get(timeline, 0)
         for tweet in data:
-            # XXX this is a good point to save the latest "created_at" we see,
-            # so we can use this value in the next friends_timeline request
-            # and get less data.
+            newest = max(newest, tweet.id)
 
-            created_at = tweet['created_at']
-            self.log.debug('Created at: %s' % (created_at))
-            tweet['created_at'] = _to_datetime(created_at)
-            tweet['text'] = urllib2.unquote(tweet['text'])
+        if timeline and newest:
+            self.since_ids[timeline] = newest
 
         user_callback(data, error, *args, **kwargs)
         return
@@ -225,49 +610,52 @@ class Twitter(object):
         # same as the friends timeline, we call our own callback to convert
         # the 'created_at' field to a datetime
 
-        self.request('/statuses/update', self.post_update,
+        return self.request('/statuses/update', self.post_update,
                 user_callback=callback, body=body, *args, **kwargs)
-        return
 
     def post_update(self, response, error, user_callback, *args, **kwargs):
         """Function called after the update. We intercept this before calling
-        the user callback to convert the 'created_at' field to a datetime
-        object."""
+        the user callback to convert the response to a Status."""
 
         if response and 'created_at' in response:
-            response['created_at'] = _to_datetime(response['created_at'])
+            response = Status.from_json(response)
 
         user_callback(response, error, *args, **kwargs)
         return
 
-    def download(self, url, callback, *args, **kwargs):
-        """Load an external element."""
+    def download(self, url, callback, priority=RequestScheduler.MEDIA,
+            cache=False, *args, **kwargs):
+        """Load an external element. <cache> can be a cache object (see
+        ThreadHTTP.request) to make the download conditional. Like request(),
+        returns the request handle."""
         headers = self._common_headers()
         del headers['Authorization']    # why, we don't need that!
 
         worker = self.workers[0]
-        worker.request(callback, url, headers, None, jsonify=False,
-                *args, **kwargs)
-        return
+        return worker.request(callback, url, headers, None, False, cache,
+                priority, *args, **kwargs)
 
     def tweet_destroy(self, tweet_id, callback, *args, **kwargs):
         """Delete a tweet."""
 
         body = urllib.urlencode({'id': tweet_id}) # Force POST method
         resource = '/statuses/destroy/%s' % (tweet_id)
-        data = self.request(resource, callback, body=body, *args, **kwargs)
-        return
+        return self.request(resource, callback, body=body, *args, **kwargs)
 
     def friends_list(self, callback, *args, **kwargs):
         """Get list of folks followed by user"""
-        return self.request('/statuses/friends', callback, *args, **kwargs)
+        return self.request('/statuses/friends', callback, cache=True,
+                *args, **kwargs)
 
-    def replies(self, callback, *args, **kwargs):
-        """Get a list of replies to the authenticated user."""
-        return self.request('/statuses/replies', self._update_fields,
-                user_callback=callback, *args, **kwargs)
+    def replies(self, callback, incremental=True, stream=None, *args,
+            **kwargs):
+        """Get a list of replies to the authenticated user. Like
+        friends_timeline, only the new replies are retrieved unless
+        <incremental> is False."""
+        return self._timeline('replies', callback, incremental, stream,
+                *args, **kwargs)
 
     def rate_limit_status(self, callback, *args, **kwargs):
         """Return the current user rate limit."""
         return self.request('/account/rate_limit_status', callback,
-                *args, **kwargs)
+                cache=True, *args, **kwargs)
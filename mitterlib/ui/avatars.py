@@ -0,0 +1,513 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Mitter, a Maemo client for Twitter.
+# Copyright (C) 2007, 2008  Julio Biason, Deepak Sarda
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import os.path
+import hashlib
+import threading
+import logging
+import time
+import Queue
+import json
+
+from collections import OrderedDict
+
+
+class AvatarCache(object):
+    """Keeps the user pics on disk, so we don't need to download every one
+    of them again every time Mitter starts. Each pic is stored in a file
+    named after the hash of its URL; an index keeps the validators sent by
+    the server and when the pic was last checked.
+
+    Pics checked less than <max_age> seconds ago can be used directly (see
+    fresh() and load()); older ones must be downloaded again, but this object
+    has the same interface as threadhttp.ValidatorCache, so it can be passed
+    as the cache of the download, which then is a conditional request and,
+    if the pic didn't change, gives back the stored pic.
+
+    The pics are stored after going through <convert> (if set), so the
+    interface can store them already scaled. The total size is kept under
+    <max_bytes>, removing the least recently used pics first."""
+
+    INDEX = 'index.json'
+
+    # how many changes we accept before saving the index again
+    SAVE_INTERVAL = 20
+
+    def __init__(self, path=None, max_bytes=2*1024*1024,
+            max_age=3*24*60*60, convert=None):
+        if path is None:
+            path = os.path.expanduser(os.path.join('~', '.mitter',
+                'avatars'))
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.convert = convert
+
+        # url -> [filename, etag, last_modified, last checked, size]
+        self._entries = OrderedDict()
+        self._size = 0
+        self._changes = 0
+        self._lock = threading.Lock()
+        self._log = logging.getLogger('ui.avatars')
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._load_index()
+
+    def _filename(self, url):
+        """Return the name of the file for the pic of <url>."""
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return '%s.png' % (hashlib.sha1(url).hexdigest())
+
+    def _load_index(self):
+        """Read the index and remove the files which are not in it
+        anymore."""
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            # already exists (or we can't create it, in which case we'll
+            # find out later)
+            pass
+
+        try:
+            index = file(os.path.join(self.path, self.INDEX), 'r')
+            try:
+                entries = json.loads(index.read())
+            finally:
+                index.close()
+        except (IOError, ValueError), exc:
+            self._log.debug('No avatar index: %s' % (exc))
+            entries = []
+
+        for entry in entries:
+            try:
+                (url, filename, etag, last_modified, checked) = entry
+                size = os.path.getsize(os.path.join(self.path, filename))
+            except (ValueError, TypeError, OSError):
+                continue
+            self._entries[url] = [filename, etag, last_modified, checked,
+                    size]
+            self._size += size
+
+        known = set([entry[0] for entry in self._entries.itervalues()])
+        known.add(self.INDEX)
+        try:
+            for filename in os.listdir(self.path):
+                if filename not in known:
+                    self._log.debug('Removing orphan pic %s' % (filename))
+                    self._unlink(filename)
+        except OSError:
+            pass
+
+        self._log.debug('%d avatars in the cache (%d bytes)' %
+                (len(self._entries), self._size))
+        return
+
+    def save(self):
+        """Write the index to disk."""
+        self._lock.acquire()
+        try:
+            entries = [[url, filename, etag, last_modified, checked] for
+                    (url, (filename, etag, last_modified, checked, _)) in
+                    self._entries.iteritems()]
+            self._changes = 0
+        finally:
+            self._lock.release()
+
+        filename = os.path.join(self.path, self.INDEX)
+        try:
+            # write somewhere else first, so a crash doesn't leave half an
+            # index behind
+            index = file(filename + '.tmp', 'w')
+            index.write(json.dumps(entries))
+            index.close()
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError), exc:
+            self._log.error('Error saving the avatar index: %s' % (exc))
+        return
+
+    def _changed(self):
+        """Save the index, if there were enough changes. Must be called
+        without the lock."""
+        if self._changes >= self.SAVE_INTERVAL:
+            self.save()
+        return
+
+    def _unlink(self, filename):
+        """Remove a pic file, ignoring errors."""
+        try:
+            os.remove(os.path.join(self.path, filename))
+        except OSError:
+            pass
+        return
+
+    def _read(self, url):
+        """Return the (entry, data) for <url>, marking it as the most
+        recently used, or (None, None) if it's not in the cache."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(url, None)
+            if entry is None:
+                return (None, None)
+            self._entries[url] = entry
+        finally:
+            self._lock.release()
+
+        try:
+            pic = file(os.path.join(self.path, entry[0]), 'rb')
+            try:
+                return (entry, pic.read())
+            finally:
+                pic.close()
+        except IOError, exc:
+            self._log.debug('Error reading pic of %s: %s' % (url, exc))
+            self.remove(url)
+            return (None, None)
+
+    def fresh(self, url):
+        """True if the pic of <url> is in the cache and can be used without
+        checking with the server."""
+        entry = self._entries.get(url)
+        return entry is not None and time.time() - entry[3] < self.max_age
+
+    def load(self, url):
+        """Return the stored pic of <url>, or None if it's not in the
+        cache."""
+        (entry, data) = self._read(url)
+        if data is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return data
+
+    def get(self, url):
+        """Return the (etag, last_modified, data, size) of <url>, or None if
+        it's not in the cache. Same as ValidatorCache.get(), including the
+        hits and misses: ThreadHTTP counts them once the response arrives
+        (a 304 is a hit, anything else a miss), so they aren't counted
+        here."""
+        (entry, data) = self._read(url)
+        if data is None:
+            return None
+        return (entry[1], entry[2], data, entry[4])
+
+    def headers(self, entry):
+        """Return the headers to make a conditional request for the cached
+        <entry>."""
+        (etag, last_modified, _, _) = entry
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def put(self, url, etag, last_modified, data, size=None):
+        """Store the pic of <url>. Same as ValidatorCache.put(), except the
+        <size> is the size of what we store, so it's ignored."""
+        if self.convert:
+            try:
+                data = self.convert(data)
+            except Exception, exc:
+                self._log.debug('Not storing pic of %s: %s' % (url, exc))
+                return
+        if not data:
+            return
+
+        size = len(data)
+        if size > self.max_bytes:
+            return
+
+        filename = self._filename(url)
+        try:
+            pic = file(os.path.join(self.path, filename + '.tmp'), 'wb')
+            pic.write(data)
+            pic.close()
+            os.rename(os.path.join(self.path, filename + '.tmp'),
+                    os.path.join(self.path, filename))
+        except (IOError, OSError), exc:
+            self._log.error('Error storing pic of %s: %s' % (url, exc))
+            return
+
+        evicted = []
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(url, None)
+            if old is not None:
+                self._size -= old[4]
+
+            self._entries[url] = [filename, etag, last_modified, time.time(),
+                    size]
+            self._size += size
+            self._changes += 1
+
+            while self._size > self.max_bytes:
+                (_, old) = self._entries.popitem(last=False)
+                self._size -= old[4]
+                self.evictions += 1
+                evicted.append(old[0])
+        finally:
+            self._lock.release()
+
+        for filename in evicted:
+            self._unlink(filename)
+        self._changed()
+        return
+
+    def touch(self, url):
+        """The server confirmed the pic of <url> didn't change."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(url)
+            if entry is not None:
+                entry[3] = time.time()
+                self._changes += 1
+        finally:
+            self._lock.release()
+        self._changed()
+        return
+
+    def remove(self, url):
+        """Remove the pic of <url> from the cache."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(url, None)
+            if entry is not None:
+                self._size -= entry[4]
+                self._changes += 1
+        finally:
+            self._lock.release()
+
+        if entry is not None:
+            self._unlink(entry[0])
+        return
+
+    def prewarm(self, callback, limit=None):
+        """Load the fresh pics in a background thread, the most recently used
+        first, calling <callback> with the url and the data of each one.
+        Returns the thread."""
+        urls = [url for url in reversed(self._entries.keys()) if
+                self.fresh(url)]
+        if limit is not None:
+            urls = urls[:limit]
+
+        def _prewarm():
+            self._log.debug('Loading %d pics from the cache' % (len(urls)))
+            for url in urls:
+                data = self.load(url)
+                if data is not None:
+                    callback(url, data)
+            return
+
+        thread = threading.Thread(target=_prewarm)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        """Return the cache counters."""
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._size}
+
+
+class PicLoader(object):
+    """Decodes the user pics in a pool of threads, so the interface doesn't
+    stop while the pics are loaded. <decode> is called (in one of the
+    threads) with the url and the data of the pic and returns whatever the
+    interface needs (or None if the pic is invalid.)
+
+    The results are delivered in batches: when the first result of a batch
+    is ready, <schedule> (e.g., gobject.idle_add) is called once to run the
+    delivery; when it runs, <deliver> receives a list of (url, result) with
+    everything that's ready by then."""
+
+    def __init__(self, decode, deliver, schedule, threads=2):
+        self.decode = decode
+        self.deliver = deliver
+        self.schedule = schedule
+
+        self._queue = Queue.Queue()
+        self._ready = []
+        self._scheduled = False
+        self._lock = threading.Lock()
+        self._log = logging.getLogger('ui.avatars.loader')
+
+        self._threads = []
+        for id in xrange(threads):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+        self.batches = 0
+        self.loaded = 0
+
+    def put(self, url, data=None):
+        """Decode the pic of <url>."""
+        self._queue.put((url, data))
+        return
+
+    def close(self):
+        """Stop the threads, once the pics already queued are done."""
+        for thread in self._threads:
+            self._queue.put(None)
+        return
+
+    def _work(self):
+        """Decode the pics in the queue, until we get a None."""
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+
+            (url, data) = job
+            try:
+                result = self.decode(url, data)
+            except Exception, exc:
+                self._log.debug('Error decoding pic %s: %s' % (url, exc))
+                result = None
+
+            self._lock.acquire()
+            try:
+                self._ready.append((url, result))
+                if self._scheduled:
+                    continue
+                self._scheduled = True
+            finally:
+                self._lock.release()
+
+            self.schedule(self._flush)
+        return
+
+    def _flush(self):
+        """Deliver all the pics decoded so far."""
+        self._lock.acquire()
+        try:
+            ready = self._ready
+            self._ready = []
+            self._scheduled = False
+        finally:
+            self._lock.release()
+
+        if ready:
+            self.batches += 1
+            self.loaded += len(ready)
+            self.deliver(ready)
+        return False    # so idle_add doesn't call us again
+
+
+class PixbufCache(object):
+    """Keeps the decoded user pics in memory, up to <max_bytes>. <sizeof>
+    returns the size of a pic; when the cache goes over the limit, the least
+    recently used pics are removed -- except the ones in the set returned by
+    <in_use>, which are still being displayed (and which may keep the cache
+    over the limit, if there are too many of them.)
+
+    Works like a dictionary, but only get() (and the [] operator) count as
+    hits and misses. Not thread-safe; it's used only in the main loop."""
+
+    def __init__(self, max_bytes, sizeof, in_use=None):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.in_use = in_use
+
+        self._pics = OrderedDict()  # url -> (pic, size)
+        self._size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, url):
+        return url in self._pics
+
+    def __len__(self):
+        return len(self._pics)
+
+    def get(self, url, default=None):
+        """Return the pic of <url>, or <default> if it's not in the
+        cache."""
+        entry = self._pics.pop(url, None)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._pics[url] = entry     # now the most recently used
+        return entry[0]
+
+    def __getitem__(self, url):
+        pic = self.get(url)
+        if pic is None:
+            raise KeyError(url)
+        return pic
+
+    def __setitem__(self, url, pic):
+        old = self._pics.pop(url, None)
+        if old is not None:
+            self._size -= old[1]
+
+        size = self.sizeof(pic)
+        self._pics[url] = (pic, size)
+        self._size += size
+
+        if self._size > self.max_bytes:
+            self._evict()
+        return
+
+    def __delitem__(self, url):
+        (_, size) = self._pics.pop(url)
+        self._size -= size
+        return
+
+    def _evict(self):
+        """Remove the least recently used pics not in use, until the cache
+        is under the limit again."""
+        if self.in_use:
+            in_use = self.in_use()
+        else:
+            in_use = set()
+
+        for url in self._pics.keys():
+            if self._size <= self.max_bytes:
+                break
+            if url in in_use:
+                continue
+
+            del self[url]
+            self.evictions += 1
+        return
+
+    def stats(self):
+        """Return the cache counters."""
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._pics),
+                'bytes': self._size}
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Mitter, a Maemo client for Twitter.
+# Copyright (C) 2007, 2008  Julio Biason, Deepak Sarda
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import calendar
+import datetime
+
+from mitterlib.twitter import Status, User
+
+
+class Timeline(object):
+    """A compact list of statuses, sorted from the newest to the oldest.
+
+    Each status is kept as a record -- a tuple with the id, the User, the
+    text, when it was posted (in seconds since the epoch) and the id of the
+    status it replies to. The interfaces can get the status back as a
+    Status with status().
+
+    The record of a status is always the same object while the status is in
+    the list."""
+
+    def __init__(self):
+        self._keys = []         # -id of the statuses, so newest come first
+        self._statuses = {}     # id -> record
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, id):
+        return int(id) in self._statuses
+
+    def __iter__(self):
+        """Iterate over the ids, from the newest to the oldest."""
+        for key in self._keys:
+            yield -key
+
+    def _user(self, user):
+        """Return the shared User for <user> (a User or a dictionary.)"""
+        if isinstance(user, User):
+            return user
+        return User.shared(user)
+
+    def add(self, status):
+        """Add the <status> (a Status, or a dictionary like it) in its
+        place. Returns the position of the
+        new status, or None if it was already in the list."""
+        id = int(status['id'])
+        if id in self._statuses:
+            return None
+
+        posted = calendar.timegm(status['created_at'].timetuple())
+        self._statuses[id] = (id, self._user(status['user']),
+                status['text'], posted, status.get('in_reply_to_status_id'))
+
+        position = bisect.bisect_left(self._keys, -id)
+        self._keys.insert(position, -id)
+        return position
+
+    def remove(self, id):
+        """Remove the status <id>. Returns the position it had, or None if
+        it wasn't in the list."""
+        id = int(id)
+        if self._statuses.pop(id, None) is None:
+            return None
+
+        position = self.position(id)
+        del self._keys[position]
+        return position
+
+    def truncate(self, size):
+        """Remove the oldest statuses, so there are only <size> left.
+        Returns the ids of the removed statuses, from the newest to the
+        oldest."""
+        removed = [-key for key in self._keys[size:]]
+        del self._keys[size:]
+        for id in removed:
+            del self._statuses[id]
+        return removed
+
+    def clear(self):
+        """Remove all the statuses."""
+        self._keys = []
+        self._statuses = {}
+        return
+
+    def position(self, id):
+        """Return the position of the status <id> in the list (which must be
+        in the list.)"""
+        return bisect.bisect_left(self._keys, -int(id))
+
+    def id_at(self, position):
+        """Return the id of the status at <position>."""
+        return -self._keys[position]
+
+    def record_at(self, position):
+        """Return the record of the status at <position>."""
+        return self._statuses[-self._keys[position]]
+
+    def get(self, id):
+        """Return the record of status <id>."""
+        return self._statuses[int(id)]
+
+    def status(self, id):
+        """Return status <id> as a Status."""
+        (id, user, text, posted, reply_to) = self._statuses[int(id)]
+        return Status(id, text, datetime.datetime.utcfromtimestamp(posted),
+                reply_to, user)
+
+    def pics(self):
+        """Return the set of pics of the users with statuses in the
+        list."""
+        users = set([record[1] for record in self._statuses.itervalues()])
+        return set([user.profile_image_url for user in users])
@@ -18,7 +18,6 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
-import math
 import time
 
 
@@ -27,6 +26,17 @@ import time
 # My version expects time to be given in UTC & returns timedelta from UTC.
 
 
+# the units we display, from the biggest to the smallest: (seconds,
+# singular, plural)
+CHUNKS = (
+    (60 * 60 * 24 * 365, 'year', 'years'),
+    (60 * 60 * 24 * 30, 'month', 'months'),
+    (60 * 60 * 24 * 7, 'week', 'weeks'),
+    (60 * 60 * 24, 'day', 'days'),
+    (60 * 60, 'hour', 'hours'),
+    (60, 'minute', 'minutes'))
+
+
 def pluralize(singular, plural, count):
     if count == 1:
         return singular
@@ -34,19 +44,55 @@ def pluralize(singular, plural, count):
         return plural
 
 
+def _bucket(since):
+    """Return the bucket of <since> seconds -- everything in the same
+    bucket is displayed the same way -- and how many seconds after the
+    start of the count the next bucket starts. The bucket is a tuple with
+    the index of the unit in CHUNKS, the count of it and the count of the
+    next unit; (None, 0, 0) means "moments"."""
+    if since <= 0:
+        return ((None, 0, 0), 1)
+
+    for i, (seconds, _, _) in enumerate(CHUNKS):
+        count = since / seconds
+        if count != 0:
+            break
+
+    # next time the count changes, or a bigger unit kicks in
+    boundary = seconds * (count + 1)
+    if i > 0:
+        boundary = min(boundary, CHUNKS[i - 1][0])
+
+    count2 = 0
+    if i + 1 < len(CHUNKS):
+        # Now get the second item
+        seconds2 = CHUNKS[i + 1][0]
+        count2 = (since - (seconds * count)) / seconds2
+        boundary = min(boundary, seconds * count + seconds2 * (count2 + 1))
+
+    return ((i, count, count2), boundary)
+
+
+def _label(bucket):
+    """Format a <bucket> (see _bucket.)"""
+    (i, count, count2) = bucket
+    if i is None:
+        return 'moments'
+
+    (_, singular, plural) = CHUNKS[i]
+    s = '%d %s' % (count, pluralize(singular, plural, count))
+    if count2 != 0:
+        (_, singular, plural) = CHUNKS[i + 1]
+        s += ', %d %s' % (count2, pluralize(singular, plural, count2))
+    return s
+
+
 def timesince(d, now=None):
     """
     Takes two datetime objects and returns the time between then and now
     as a nicely formatted string, e.g "10 minutes"
     Adapted from http://blog.natbat.co.uk/archive/2003/Jun/14/time_since
     """
-    chunks = (
-        (60 * 60 * 24 * 365, lambda n: pluralize('year', 'years', n)),
-        (60 * 60 * 24 * 30, lambda n: pluralize('month', 'months', n)),
-        (60 * 60 * 24 * 7, lambda n: pluralize('week', 'weeks', n)),
-        (60 * 60 * 24, lambda n: pluralize('day', 'days', n)),
-        (60 * 60, lambda n: pluralize('hour', 'hours', n)),
-        (60, lambda n: pluralize('minute', 'minutes', n)))
     # Convert datetime.date to datetime.datetime for comparison
     if d.__class__ is not datetime.datetime:
         d = datetime.datetime(d.year, d.month, d.day)
@@ -59,25 +105,50 @@ def timesince(d, now=None):
     # ignore microsecond part of 'd' since we removed it from 'now'
     delta = now - (d - datetime.timedelta(0, 0, d.microsecond))
     since = delta.days * 24 * 60 * 60 + delta.seconds
-    if since <= 0:
-        return 'moments'
+    return _label(_bucket(since)[0])
 
-    for i, (seconds, name) in enumerate(chunks):
-        count = since / seconds
-        if count != 0:
-            break
 
-    if count < 0:
-        return '%d milliseconds' % math.floor((now - d).microseconds / 1000)
+class RelativeTime(object):
+    """Formats the time since many timestamps (seconds since the epoch, in
+    UTC), all against the same sample of the clock, taken by tick() --
+    e.g., once for every redraw of the interface.
 
-    s = '%d %s' % (count, name(count))
-    if i + 1 < len(chunks):
-        # Now get the second item
-        seconds2, name2 = chunks[i + 1]
-        count2 = (since - (seconds * count)) / seconds2
-        if count2 != 0:
-            s += ', %d %s' % (count2, name2(count2))
-    return s
+    Timestamps in the same bucket (e.g., "3 minutes" or "2 hours, 5
+    minutes") are displayed the same way, so the labels are built once per
+    bucket. Along with the label, we return when the next bucket starts, so
+    the interface knows when the label changes."""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.now = int(clock())
+        self._labels = {}   # bucket -> label
+
+    def tick(self):
+        """Take a new sample of the clock and return it."""
+        self.now = int(self.clock())
+        return self.now
+
+    def label(self, posted):
+        """Return the label for the time since <posted> and the timestamp
+        when it changes."""
+        (bucket, boundary) = _bucket(self.now - posted)
+        label = self._labels.get(bucket)
+        if label is None:
+            label = _label(bucket)
+            self._labels[bucket] = label
+        return (label, posted + boundary)
+
+    def labels(self, timestamps):
+        """Same as label(), for a list of <timestamps>."""
+        return [self.label(posted) for posted in timestamps]
+
+    def next_change(self, timestamps):
+        """Return when the first of the labels of <timestamps> changes, or
+        None if there are no timestamps."""
+        changes = [change for (_, change) in self.labels(timestamps)]
+        if not changes:
+            return None
+        return min(changes)
 
 
 def timeuntil(d, now=None):
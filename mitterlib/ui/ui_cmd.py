@@ -23,9 +23,18 @@ import mitterlib.ui.console_utils as console_utils
 import mitterlib.constants
 import datetime
 
+from mitterlib.store import open_store
+from mitterlib.search import SearchIndex
+
 namespace = 'cmd'
 threads = 1 # So no threads
 
+# how many of the stored tweets are displayed when the interface starts
+STARTUP_TWEETS = 20
+
+# how many tweets the search command displays
+SEARCH_RESULTS = 20
+
 
 def options(parser):
     # no options for this interface
@@ -49,6 +58,25 @@ class Interface(cmd.Cmd):
         self._twitter.replies(self._show_tweets, watched_field='last_reply')
         return
 
+    def do_search(self, line):
+        """Search the tweets you already have. Use words, @user, URLs,
+        prefix* or "a phrase"; only the tweets with all of them are
+        shown."""
+        if not line.strip():
+            print 'Search for what?'
+            return
+
+        ids = self._index.search(line, limit=SEARCH_RESULTS)
+        tweets = [self._store.get(id) for id in ids]
+        tweets = [tweet for tweet in tweets if tweet]
+        if not tweets:
+            print 'No tweets found.'
+            return
+
+        self._tweets = console_utils.print_tweets(tweets, 0,
+                show_numbers=True)
+        return
+
     def do_update(self, line):
         """Update your status."""
         if len(line) > 160:
@@ -78,6 +106,8 @@ class Interface(cmd.Cmd):
         """Quit the application."""
         self._log.debug('Exiting application')
         self._twitter.close()
+        if self._store:
+            self._store.close()
         self._log.debug('Connection closed')
         return True
 
@@ -96,7 +126,8 @@ class Interface(cmd.Cmd):
             return
 
         real_tweet_id = self._tweets[tweet_id - 1]
-        self._twitter.tweet_destroy(real_tweet_id, self._post_delete)
+        self._twitter.tweet_destroy(real_tweet_id, self._post_delete,
+                tweet_id=real_tweet_id)
         return
 
     def emptyline(self):
@@ -133,6 +164,9 @@ class Interface(cmd.Cmd):
             print 'Sorry, couldn\'t download your friends timeline.'
             return
 
+        if watched_field == 'last_tweet' and self._store:
+            self._store.add(data)
+
         last_seen_tweet = self._prefs[watched_field]
 
         self._tweets = console_utils.print_tweets(data, last_seen_tweet,
@@ -159,7 +193,7 @@ class Interface(cmd.Cmd):
             print 'Your status was updated.'
         return
 
-    def _post_delete(self, data, error):
+    def _post_delete(self, data, error, tweet_id=None):
         """Function called after we delete a tweet."""
         if error:
             if error == 403:
@@ -174,6 +208,8 @@ class Interface(cmd.Cmd):
                 print 'Error deleting tweet.'
         else:
             print 'Tweet deleted.'
+            if self._store:
+                self._store.remove(tweet_id)
         self._refresh_rate_limit()
         return
 
@@ -219,11 +255,18 @@ class Interface(cmd.Cmd):
         self._password = password
         self._https = https
         self._tweets = []
+        self._store = None
+        self._index = SearchIndex()     # what's in the store
 
         self._prefs = {
             'last_reply': int(prefs.get('last_reply', 0)),
             'last_tweet': int(prefs.get('last_tweet', 0))}
 
+        # no need to download again what we already displayed
+        self._twitter.set_since_id('friends_timeline',
+                self._prefs['last_tweet'])
+        self._twitter.set_since_id('replies', self._prefs['last_reply'])
+
         intro = ['Welcome %s to Mitter %s.' % (username,
             mitterlib.constants.version),
             '',
@@ -247,5 +290,14 @@ class Interface(cmd.Cmd):
             console_utils.authorization(self._save, namespace, self._prefs,
                     connection=self._twitter)
 
+        # show what we already have, and ask only for what came after it
+        self._store = open_store(self._twitter.username, index=self._index)
+        stored = self._store.latest(STARTUP_TWEETS)
+        if stored:
+            self._tweets = console_utils.print_tweets(stored, 0,
+                    show_numbers=True)
+            self._twitter.set_since_id('friends_timeline',
+                    max(self._prefs['last_tweet'], self._store.newest_id()))
+
         self.cmdloop()
         return
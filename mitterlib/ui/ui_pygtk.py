@@ -28,6 +28,7 @@ gtk.gdk.threads_init()
 import datetime
 import re
 import sys
+import urllib
 import os
 import os.path
 import timesince
@@ -36,10 +37,16 @@ import logging
 import mitterlib as util
 
 from notify import Notify
+from avatars import AvatarCache, PicLoader, PixbufCache
+from timeline import Timeline
 from mitterlib.constants import gpl_3, version
 from mitterlib.ui.utils import str_len
+from mitterlib.threadhttp import RequestScheduler
+from mitterlib.store import open_store
+from mitterlib.search import SearchIndex
 
 from optparse import OptionGroup
+from collections import OrderedDict
 
 namespace = 'pygtk'
 threads = 2
@@ -62,12 +69,233 @@ def options(parser):
 
 # Constants
 
-MAX_STATUS_DISPLAY = 60
+MAX_STATUS_DISPLAY = 20000
+
+# how many of the stored tweets are displayed when Mitter starts
+STARTUP_TWEETS = 200
+
+# how long (in milliseconds) the window size must stay the same before we
+# redo the word-wrapping
+RELAYOUT_DELAY = 100
+
+# how long (in milliseconds) the user must stop typing in the filter before
+# we search
+FILTER_DELAY = 300
+
+# how many tweets the filter displays
+FILTER_RESULTS = 1000
+
+# older tweets are requested when the list is scrolled to less than this
+# many pages from the bottom
+BACKFILL_PAGES = 2
+
+# memory used by the decoded user pics (the ones on screen are always kept)
+MAX_PICS_BYTES = 2 * 1024 * 1024
 
 url_re = re.compile(r'(https?://[^\s\n\r]+)', re.I)
+entity_re = re.compile(r'&(?!(amp;|gt;|lt;|quot;|apos;))')
 
 class Columns:
-    (PIC, NAME, MESSAGE, USERNAME, ID, DATETIME, ALL_DATA) = range(7)
+    (PIC, NAME, MESSAGE, USERNAME, ID, DATETIME, ALL_DATA, SORT_KEY,
+            MARKUP) = range(9)
+
+
+class MessageMarkup(object):
+    """The markup displayed for a tweet. The <text> part (user and message)
+    is built once, when the tweet is added to the list; only the time since
+    the tweet was posted is updated (using the <clock>, a
+    timesince.RelativeTime), and only when it changes."""
+
+    def __init__(self, text, posted, clock):
+        self.text = text
+        self.posted = posted
+        self.clock = clock
+
+        self._markup = None
+        self.update()
+
+    def set_text(self, text):
+        """Replace the <text> part of the markup."""
+        self.text = text
+        self._markup = None
+        return
+
+    def update(self):
+        """Format the time again. Returns True if it changed."""
+        (label, self.expires) = self.clock.label(self.posted)
+        if self._markup is not None and label == self.label:
+            return False
+
+        self.label = label
+        self._markup = None
+        return True
+
+    def get(self):
+        """Return the markup, as it should be at the last clock tick."""
+        if self.clock.now >= self.expires:
+            self.update()
+        if self._markup is None:
+            self._markup = '%s\n<small>%s</small>' % (self.text,
+                    self.label)
+        return self._markup
+
+
+class TimelineModel(gtk.GenericTreeModel):
+    """The model of the list of tweets, backed by a Timeline. The values of
+    the rows are only built when the view asks for them; the markups (built
+    by <markup>, a function which receives the Timeline record) are kept
+    only for the last <max_markups> rows used."""
+
+    column_types = (str, str, str, str, str, object, object,
+            gobject.TYPE_INT64, object)
+
+    def __init__(self, markup, max_markups=500):
+        gtk.GenericTreeModel.__init__(self)
+        # the rows are the Timeline records, which are kept by the timeline
+        self.set_property('leak-references', False)
+
+        self.timeline = Timeline()
+        self.markup = markup
+        self.max_markups = max_markups
+        self._markups = OrderedDict()   # id -> MessageMarkup
+
+    # changing the model
+
+    def add(self, status):
+        """Add the <status> in its place. Returns False if it was already in
+        the list."""
+        position = self.timeline.add(status)
+        if position is None:
+            return False
+
+        path = (position,)
+        self.row_inserted(path, self.get_iter(path))
+        return True
+
+    def remove(self, id):
+        """Remove the status <id>."""
+        position = self.timeline.remove(id)
+        if position is not None:
+            self._markups.pop(int(id), None)
+            self.row_deleted((position,))
+        return
+
+    def truncate(self, size):
+        """Remove the oldest statuses, keeping only <size> of them. Returns
+        the removed ids."""
+        removed = self.timeline.truncate(size)
+        for id in removed:
+            self._markups.pop(id, None)
+        for position in xrange(size + len(removed) - 1, size - 1, -1):
+            self.row_deleted((position,))
+        return removed
+
+    def clear(self):
+        """Remove all the statuses."""
+        size = len(self.timeline)
+        self.timeline.clear()
+        self._markups.clear()
+        for position in xrange(size - 1, -1, -1):
+            self.row_deleted((position,))
+        return
+
+    def row_updated(self, id):
+        """Tell the view that status <id> changed."""
+        path = (self.timeline.position(id),)
+        self.row_changed(path, self.get_iter(path))
+        return
+
+    def has_status(self, id):
+        """True if the status <id> is in the list."""
+        return id in self.timeline
+
+    def markups(self):
+        """Return the (id, markup) of the markups built so far."""
+        return self._markups.items()
+
+    def reset_markups(self):
+        """Forget the markups, so they are built again."""
+        self._markups.clear()
+        return
+
+    def _markup(self, record):
+        """Return the markup of <record>, building it if needed."""
+        id = record[0]
+        markup = self._markups.pop(id, None)
+        if markup is None:
+            markup = self.markup(record)
+            if len(self._markups) >= self.max_markups:
+                self._markups.popitem(last=False)
+        self._markups[id] = markup
+        return markup
+
+    # GenericTreeModel interface
+
+    def on_get_flags(self):
+        return gtk.TREE_MODEL_LIST_ONLY | gtk.TREE_MODEL_ITERS_PERSIST
+
+    def on_get_n_columns(self):
+        return len(self.column_types)
+
+    def on_get_column_type(self, index):
+        return self.column_types[index]
+
+    def on_get_iter(self, path):
+        if path[0] < len(self.timeline):
+            return self.timeline.record_at(path[0])
+        return None
+
+    def on_get_path(self, record):
+        return (self.timeline.position(record[0]),)
+
+    def on_get_value(self, record, column):
+        (id, user, text, posted, _) = record
+        if column == Columns.PIC:
+            return user.profile_image_url
+        elif column == Columns.NAME:
+            return user.name
+        elif column == Columns.MESSAGE:
+            return text
+        elif column == Columns.USERNAME:
+            return user.screen_name
+        elif column == Columns.ID:
+            return str(id)
+        elif column == Columns.DATETIME:
+            return datetime.datetime.utcfromtimestamp(posted)
+        elif column == Columns.ALL_DATA:
+            return self.timeline.status(id)
+        elif column == Columns.SORT_KEY:
+            return id
+        elif column == Columns.MARKUP:
+            return self._markup(record)
+        return None
+
+    def on_iter_next(self, record):
+        position = self.timeline.position(record[0]) + 1
+        if position < len(self.timeline):
+            return self.timeline.record_at(position)
+        return None
+
+    def on_iter_children(self, parent):
+        if parent is None and len(self.timeline):
+            return self.timeline.record_at(0)
+        return None
+
+    def on_iter_has_child(self, record):
+        return False
+
+    def on_iter_n_children(self, record):
+        if record is None:
+            return len(self.timeline)
+        return 0
+
+    def on_iter_nth_child(self, parent, n):
+        if parent is None and n < len(self.timeline):
+            return self.timeline.record_at(n)
+        return None
+
+    def on_iter_parent(self, child):
+        return None
 
 
 # This is the main class, used by the mitter executable to display the
@@ -82,8 +310,44 @@ class Interface(object):
             https, connection, prefs):
         """Class initialization."""
 
-        self.user_pics = {}
-        self.pic_queue = set()
+        self.user_pics = PixbufCache(MAX_PICS_BYTES,
+                lambda pic: pic.get_rowstride() * pic.get_height(),
+                self.pics_in_use)
+        self.pic_queue = {}     # pic url -> download request
+
+        # the pics are stored on disk already scaled
+        self.avatars = AvatarCache(convert=self.scale_pic)
+
+        # pics are decoded away from the main loop and go to the grid in
+        # batches
+        self.pic_loader = PicLoader(self.decode_pic, self.post_pic_load,
+                gobject.idle_add)
+
+        self.refresh_request = None
+
+        # the tweets of the current user stored on disk, and the index to
+        # search them
+        self.store = None
+        self.index = SearchIndex()
+
+        # set when asking for older tweets brings nothing, so we stop asking
+        self.backfill_end = False
+
+        # all the times displayed in the list use the same clock
+        self.clock = timesince.RelativeTime()
+        self._times_id = None
+
+        # word-wrapping: the current wrap width, the pending relayout (after
+        # a resize) and the ids of the rows already laid out with the
+        # current width
+        self.wrap_width = None
+        self._relayout_id = None
+        self.wrapped = set()
+
+        # regular expression to highlight the user in the messages, and the
+        # user it was built for
+        self.user_re = None
+        self.user_re_name = None
 
         self.log = logging.getLogger('ui.pygtk')
         self.last_update = None
@@ -135,6 +399,7 @@ class Interface(object):
 
         self.add_grid()
         update_box = self.create_update_box()
+        filter_box = self.create_filter_box()
 
         # update the char count
 
@@ -155,11 +420,19 @@ class Interface(object):
         scrolled_window = gtk.ScrolledWindow()
         scrolled_window.set_policy(gtk.POLICY_NEVER, gtk.POLICY_ALWAYS)
         scrolled_window.add(self.grid)
+        vadjustment = scrolled_window.get_vadjustment()
+        vadjustment.connect('value-changed', self.relayout_visible)
+
+        # older tweets are loaded before the user gets to the bottom of the
+        # list (and the list size changes when they come)
+        vadjustment.connect('value-changed', self.check_backfill)
+        vadjustment.connect('changed', self.check_backfill)
 
         # the update field
 
         box = gtk.VBox(False, 1)
         box.pack_start(self.main_menu, False, True, 0)
+        box.pack_start(filter_box, False, True, 0)
         box.pack_start(scrolled_window, True, True, 0)
         box.pack_start(update_box, False, True, 0)
         box.pack_start(self.statusbar, False, False, 0)
@@ -334,12 +607,14 @@ class Interface(object):
     def add_grid(self):
         """Add the displaying grid."""
 
-        self.grid_store = gtk.ListStore(str, str, str, str, str, object,
-                object)
+        # the model keeps the tweets sorted (newest first) by the status
+        # id, so the oldest rows are always in the end.
+        self.grid_store = TimelineModel(self.row_markup)
 
-        self.grid_store.set_sort_func(Columns.DATETIME, self.sort_by_time)
-        self.grid_store.set_sort_column_id(Columns.DATETIME,
-                gtk.SORT_DESCENDING)
+        # the model in the view: grid_store or, while the list is filtered,
+        # the one with the tweets found
+        self.shown_store = self.grid_store
+        self._filter_id = None
 
         self.grid = gtk.TreeView(self.grid_store)
         self.grid.set_property('headers-visible', False)
@@ -363,6 +638,7 @@ class Interface(object):
         self.grid.append_column(self.message_column)
         self.grid.set_resize_mode(gtk.RESIZE_IMMEDIATE)
         self.grid.connect('cursor-changed', self.check_post)
+        self.grid.connect('expose-event', self.tick_clock)
         self.grid.connect('row-activated', self.open_post)
         self.grid.connect('button-press-event', self.click_post)
         
@@ -485,6 +761,20 @@ class Interface(object):
 		  else:
 		      self.main_menu.show()
 
+    def create_filter_box(self):
+        """Create the field used to filter the list."""
+
+        self.filter_text = gtk.Entry()
+        self.filter_text.connect('changed', self.schedule_filter)
+        self.filter_text.connect('activate', self.filter_grid)
+
+        filter_box = gtk.HBox(False, 0)
+        filter_box.pack_start(gtk.Label('Filter: '), False, False, 0)
+        filter_box.pack_start(self.filter_text, expand=True, fill=True,
+                padding=0)
+
+        return filter_box
+
     def create_update_box(self):
         """Create the widgets related to the update box"""
 
@@ -550,70 +840,174 @@ class Interface(object):
     # Grid cell content callback
     # ------------------------------------------------------------
 
-    def sort_by_time(self, model, iter1, iter2, data=None):
-        """The sort function where we sort by the datetime.datetime object"""
-
-        d1 = model.get_value(iter1, Columns.DATETIME)
-        d2 = model.get_value(iter2, Columns.DATETIME)
-
-        # Why do we get called with None values?!
-
-        if not d1:
-            return 1
-        if not d2:
-            return -1
-
-        if d1 < d2:
-            return -1
-        elif d1 > d2:
-            return 1
-        return 0
-
     def cell_renderer_user(self, column, cell, store, position):
         """Callback for the user column. Used to created the pixbuf of the
         userpic."""
 
         pic = store.get_value(position, Columns.PIC)
-        if not pic in self.user_pics:
+        user_pic = self.user_pics.get(pic)
+        if user_pic is None:
             cell.set_property('pixbuf', self.default_pixmap)
 
             # just make sure we download this pic too.
             self.queue_pic(pic)
         else:
-            cell.set_property('pixbuf', self.user_pics[pic])
+            cell.set_property('pixbuf', user_pic)
 
         return
 
+    def visible_rows(self):
+        """Return the (path, iter) of the rows on screen."""
+        visible = self.grid.get_visible_range()
+        if not visible:
+            return []
+
+        (start, end) = visible
+        rows = []
+        for position in xrange(start[0], end[0] + 1):
+            path = (position,)
+            rows.append((path, self.shown_store.get_iter(path)))
+        return rows
+
+    def pics_in_use(self):
+        """Return the set of pics used by the rows on screen."""
+        return set([self.shown_store.get_value(iter, Columns.PIC) for
+            (path, iter) in self.visible_rows()])
+
     def cell_renderer_message(self, column, cell, store, position):
         """Callback for the message column. We need this to adjust the markup
         property of the cell, as setting it as text won't do any markup
         processing."""
 
-        user = store.get_value(position, Columns.NAME)
-        message = store.get_value(position, Columns.MESSAGE)
-        time = store.get_value(position, Columns.DATETIME)
-        username = store.get_value(position, Columns.USERNAME)
+        markup = store.get_value(position, Columns.MARKUP)
+        cell.set_property('markup', markup.get())
+
+        return
+
+    def tick_clock(self, widget, event, data=None):
+        """Callback when the grid is going to be redrawn: all the times in
+        this redraw are based on the same sample of the clock."""
+        self.clock.tick()
+        return False
+
+    def schedule_times(self):
+        """Schedule update_times() for when the first time displayed in the
+        list changes."""
+        if self._times_id:
+            gobject.source_remove(self._times_id)
+            self._times_id = None
+
+        changes = [markup.expires for (id, markup) in
+                self.shown_store.markups()]
+        if not changes:
+            return
+
+        wait = max(1, min(changes) - self.clock.tick())
+        self._times_id = gobject.timeout_add(wait * 1000, self.update_times)
+        return
 
-        time = timesince.timesince(time)
+    def update_times(self):
+        """Redraw the rows where the time since the tweet changed."""
+        gtk.gdk.threads_enter()
+
+        self._times_id = None
+        now = self.clock.tick()
+        for (id, markup) in self.shown_store.markups():
+            if markup.expires <= now and markup.update():
+                self.shown_store.row_updated(id)
+
+        self.schedule_times()
+        gtk.gdk.threads_leave()
+        return False
+
+    def message_markup(self, user, username, message):
+        """Return the markup for the message (without the time), for the
+        MessageMarkup of a new row."""
 
         # unescape escaped entities that pango is okay with
-        message = re.sub(r'&(?!(amp;|gt;|lt;|quot;|apos;))', r'&amp;', message)
+        message = entity_re.sub(r'&amp;', message)
 
         # highlight URLs
         message = url_re.sub(r'<span foreground="blue">\1</span>',
                             message)
 
         # use a different highlight for the current user
-        message = re.sub(r'(@'+self.twitter.username+')',
-                r'<span foreground="#FF6633">\1</span>',
+        if self.user_re_name != self.twitter.username:
+            self.user_re_name = self.twitter.username
+            self.user_re = re.compile('(@%s)' % (re.escape(
+                self.twitter.username or '')))
+        if self.twitter.username:
+            message = self.user_re.sub(
+                    r'<span foreground="#FF6633">\1</span>', message)
+
+        return '<b>%s</b> <small>(%s)</small>:\n%s' % (user, username,
                 message)
 
-        markup = '<b>%s</b> <small>(%s)</small>:\n%s\n<small>%s</small>' % \
-                (user, username, message, time)
-        cell.set_property('markup', markup)
+    def row_markup(self, record):
+        """Build the MessageMarkup for a Timeline <record>; used by the
+        model."""
+        (id, user, text, posted, _) = record
+        markup = self.message_markup(user.name, user.screen_name, text)
+        return MessageMarkup(markup, posted, self.clock)
+
+    def rebuild_markup(self):
+        """Build the markup of all the rows again (e.g., because the user
+        changed.)"""
+        self.grid_store.reset_markups()
+        self.shown_store.reset_markups()
+        self.grid.queue_draw()
+        return
 
+    def schedule_filter(self, widget):
+        """Called when the filter changes; the search is done when the user
+        stops typing."""
+        if self._filter_id:
+            gobject.source_remove(self._filter_id)
+        self._filter_id = gobject.timeout_add(FILTER_DELAY,
+                self.filter_timeout)
         return
 
+    def filter_timeout(self):
+        """The user stopped typing the filter. Timeouts run without the GDK
+        lock, so we need to get it before touching the widgets."""
+        gtk.gdk.threads_enter()
+        self.filter_grid()
+        gtk.gdk.threads_leave()
+        return False
+
+    def filter_grid(self, widget=None):
+        """Show only the tweets that match the filter (the tweets are
+        searched in the index, so the ones which are not in the list
+        anymore but are still stored are found too.)"""
+        if self._filter_id:
+            gobject.source_remove(self._filter_id)
+            self._filter_id = None
+
+        query = self.filter_text.get_text().strip()
+        if not query:
+            shown = self.grid_store
+        else:
+            shown = TimelineModel(self.row_markup)
+            timeline = self.grid_store.timeline
+            for id in self.index.search(query,
+                    limit=FILTER_RESULTS):
+                if id in timeline:
+                    tweet = timeline.status(id)
+                elif self.store:
+                    tweet = self.store.get(id)
+                else:
+                    tweet = None
+                if tweet:
+                    shown.add(tweet)
+                    self.queue_pic(tweet['user']['profile_image_url'])
+            self.log.debug('%d tweets match %s' % (len(shown), query))
+
+        self.shown_store = shown
+        self.grid.set_model(shown)
+        self.wrapped = set()
+        self.schedule_times()
+        return False
+
     def cell_renderer_delete(self, column, cell, store, position):
         """Callback for the delete column. This column is used to display the
         delete tweet option, if the tweet belongs to the user."""
@@ -712,27 +1106,25 @@ class Interface(object):
         gtk.gdk.threads_enter()
 
         self.grid.freeze_child_notify()
-        self.grid.set_model(None)
-
-        # Since I don't know how to get the last row in grid_store,
-        # I'll reverse the list and then pop out the first row instead.
-
-        self.grid_store.set_sort_column_id(Columns.DATETIME,
-                gtk.SORT_ASCENDING)
 
-        iter = self.grid_store.get_iter_first()
+        # the list is always sorted, so the oldest rows are the ones after
+        # the first MAX_STATUS_DISPLAY.
 
-        while (len(self.grid_store) > MAX_STATUS_DISPLAY) and iter:
-            self.log.debug("popping off tweet with id %s" %
-                            self.grid_store.get_value(iter, Columns.ID))
-            self.grid_store.remove(iter) # iter is auto set to next row
+        removed = self.grid_store.truncate(MAX_STATUS_DISPLAY)
+        self.log.debug("popped off %d tweets" % (len(removed)))
 
-
-        self.grid_store.set_sort_column_id(Columns.DATETIME,
-                gtk.SORT_DESCENDING)
-        self.grid.set_model(self.grid_store)
         self.grid.thaw_child_notify()
 
+        # no point in downloading the pics of users which are not in the
+        # list anymore
+        pics = self.grid_store.timeline.pics()
+        for pic in self.pic_queue.keys():
+            if pic not in pics:
+                request = self.pic_queue.pop(pic, None)
+                if request:
+                    self.log.debug('Cancelling download of %s' % (pic))
+                    request.cancel()
+
         gtk.gdk.threads_leave()
         return True
 
@@ -740,24 +1132,50 @@ class Interface(object):
 
     def size_request(self, widget, requisition, data=None):
         """Callback when the window changes its sizes. We use it to set the
-        proper word-wrapping for the message column."""
+        proper word-wrapping for the message column. While the window is
+        being resized, this is called a lot, so the relayout only happens
+        when the size stops changing for a moment."""
 
         self.prefs['width'], self.prefs['height'] = self.window.get_size()
 
+        if self._relayout_id:
+            gobject.source_remove(self._relayout_id)
+        self._relayout_id = gobject.timeout_add(RELAYOUT_DELAY,
+                self.relayout)
+        return
+
+    def relayout(self):
+        """Called when the window stopped changing its size. Timeouts run
+        without the GDK lock, so we need to get it before touching the
+        widgets."""
+
+        gtk.gdk.threads_enter()
+        self._relayout_id = None
+        self.update_wrap_width()
+        gtk.gdk.threads_leave()
+        return False
+
+    def update_wrap_width(self):
+        """Set the new wrap width of the message column and redo the layout
+        of the visible rows. The other rows are done when they become
+        visible (see relayout_visible.)"""
+
         # this is based on a mail of Kristian Rietveld, on gtk maillist
 
-        if not len(self.grid_store):
+        if not len(self.shown_store):
             # nothing to rearrange
             return
 
         column = self.message_column
-        iter = self.grid_store.get_iter_first()
-        path = self.grid_store.get_path(iter)
+        path = self.shown_store.get_path(self.shown_store.get_iter_first())
 
         column_rectangle = self.grid.get_cell_area(path, column)
 
         width = column_rectangle.width
+        if width == self.wrap_width:
+            return
         self.log.debug('Width=%d' % (width))
+        self.wrap_width = width
 
         # there should be only
         renderers = column.get_cell_renderers()
@@ -765,27 +1183,45 @@ class Interface(object):
             self.log.debug('Render update')
             render.set_property('wrap-width', width)
 
-        while iter:
-            #self.log.debug('Row changed')
-            path = self.grid_store.get_path(iter)
-            self.grid_store.row_changed(path, iter)
-            iter = self.grid_store.iter_next(iter)
+        self.wrapped = set()
+        self.relayout_visible()
+        return
+
+    def relayout_visible(self, adjustment=None):
+        """Redo the layout of the visible rows which weren't laid out with
+        the current wrap width yet. Also called when the list scrolls."""
 
+        visible = self.grid.get_visible_range()
+        if not visible:
+            return
+
+        (start, end) = visible
+        for position in xrange(start[0], end[0] + 1):
+            iter = self.shown_store.get_iter((position,))
+            id = self.shown_store.get_value(iter, Columns.SORT_KEY)
+            if id in self.wrapped:
+                continue
+            self.wrapped.add(id)
+            self.shown_store.row_changed((position,), iter)
         return
 
     def quit(self, widget, user_data=None):
         """Callback when the window is destroyed (e.g. when the user closes
         the application."""
         
-        # this is really annoying: if the threads are locked doing some IO
-        # requests, the application will not quit. Displaying this message is
-        # the only option we have right now.
-        self.statusbar.push(self.statusbar_context,
-                'Finishing tasks and saving preferences...')
-
         self.log.debug('quit callback invoked. exiting now...')
+
+        # whatever is still queued or running is not needed anymore, so
+        # there is no reason to wait for it. This goes first, so no worker
+        # is still saving tweets or pics when we close things.
+        self.twitter.close(abort=True)
+
         self.save_interface_prefs()
-        self.twitter.close()
+        self.avatars.save()
+        if self.store:
+            self.store.close()
+        self.log.debug('Pics in memory: %s' % (self.user_pics.stats()))
+        self.log.debug('Pics on disk: %s' % (self.avatars.stats()))
         gtk.main_quit()
 
     def notify_reset(self, widget, event, user_data=None):
@@ -819,7 +1255,7 @@ class Interface(object):
                     # Add avatar to notify message
                     pic = self.grid_store.get_value(iter, Columns.PIC)
                     self.queue_pic(pic)
-                    avatar = self.user_pics[pic]
+                    avatar = self.user_pics.get(pic, self.default_pixmap)
                     self.log.debug('notify_broadcast with this tweet: %s' %
                             tweet)
                     break
@@ -871,7 +1307,16 @@ class Interface(object):
 
             # update the (internal) twitter prefences too!
 
+            changed_user = \
+                    self.twitter.username != self.username_field.get_text()
+            if changed_user:
+                # different user, different timeline
+                self.twitter.reset_since_ids()
             self.twitter.username = self.username_field.get_text()
+            if changed_user:
+                # and different highlights and stored tweets
+                self.rebuild_markup()
+                self.load_store()
             self.twitter.password = self.password_field.get_text()
             self.twitter.https = self.https_field.get_active()
             refresh_interval = self.refresh_interval_field.get_value_as_int()
@@ -990,9 +1435,11 @@ class Interface(object):
         self.update_text.set_sensitive(False)
         self.statusbar.push(self.statusbar_context, 'Shrinking URL...')
 
-        self.twitter.download('http://is.gd/api.php?longurl=' + longurl,
-                               self.post_shrink_url, longurl=longurl,
-                               start=start, end=end)
+        self.twitter.download('http://is.gd/api.php?' +
+                               urllib.urlencode({'longurl': longurl}),
+                               self.post_shrink_url,
+                               priority=RequestScheduler.INTERACTIVE,
+                               longurl=longurl, start=start, end=end)
 
     def post_shrink_url(self, url, error, longurl, start, end):
         if error:
@@ -1038,8 +1485,8 @@ class Interface(object):
             return
 
         path = cursor[0]
-        iter = self.grid_store.get_iter(path)
-        username = self.grid_store.get_value(iter, Columns.USERNAME)
+        iter = self.shown_store.get_iter(path)
+        username = self.shown_store.get_value(iter, Columns.USERNAME)
         text_insert = '@%s: ' % (username)
 
         self.log.debug('Inserting reply text: %s' % (text_insert))
@@ -1058,9 +1505,9 @@ class Interface(object):
             return
 
         path = cursor[0]
-        iter = self.grid_store.get_iter(path)
-        username = self.grid_store.get_value(iter, Columns.USERNAME)
-        msg = self.grid_store.get_value(iter, Columns.MESSAGE)
+        iter = self.shown_store.get_iter(path)
+        username = self.shown_store.get_value(iter, Columns.USERNAME)
+        msg = self.shown_store.get_value(iter, Columns.MESSAGE)
         text_insert = 'RT @%s: %s' % (username, msg)
 
         self.log.debug('Inserting retweet text: %s' % (text_insert))
@@ -1078,8 +1525,8 @@ class Interface(object):
             return
 
         path = cursor[0]
-        iter = self.grid_store.get_iter(path)
-        tweet_id = int(self.grid_store.get_value(iter, Columns.ID))
+        iter = self.shown_store.get_iter(path)
+        tweet_id = int(self.shown_store.get_value(iter, Columns.ID))
         self.log.debug('Deleting tweet: %d' % (tweet_id))
 
         self.statusbar.push(self.statusbar_context, 'Deleting tweet...')
@@ -1103,15 +1550,14 @@ class Interface(object):
             error_dialog.run()
             gtk.gdk.threads_leave()
         else:
-            # locate that tweet in the store and remove it.
-            iter = self.grid_store.get_iter_first()
-            tweet = int(tweet)
-            while iter:
-                id = self.grid_store.get_value(iter, Columns.ID)
-                if int(id) == tweet:
-                    self.grid_store.remove(iter)
-                    break
-                iter = self.grid_store.iter_next(iter)
+            # remove that tweet from the store.
+            gtk.gdk.threads_enter()
+            self.grid_store.remove(tweet)
+            if self.shown_store is not self.grid_store:
+                self.shown_store.remove(tweet)
+            gtk.gdk.threads_leave()
+            if self.store:
+                self.store.remove(tweet)
 
         # update the interface
         gtk.gdk.threads_enter()
@@ -1128,8 +1574,8 @@ class Interface(object):
             return
 
         path = cursor[0]
-        iter = self.grid_store.get_iter(path)
-        username = self.grid_store.get_value(iter, Columns.USERNAME)
+        iter = self.shown_store.get_iter(path)
+        username = self.shown_store.get_value(iter, Columns.USERNAME)
 
         delete_action = self.action_group.get_action('Delete')
 
@@ -1143,10 +1589,10 @@ class Interface(object):
     def open_post(self, treeview, path, view_column, user_data=None):
         """Callback when one of the rows in activated."""
 
-        iter = self.grid_store.get_iter(path)
-        username = self.grid_store.get_value(iter, Columns.USERNAME)
-        tweet_id = self.grid_store.get_value(iter, Columns.ID)
-        message = self.grid_store.get_value(iter, Columns.MESSAGE)
+        iter = self.shown_store.get_iter(path)
+        username = self.shown_store.get_value(iter, Columns.USERNAME)
+        tweet_id = self.shown_store.get_value(iter, Columns.ID)
+        message = self.shown_store.get_value(iter, Columns.MESSAGE)
         urls = url_re.search(message)
         if urls:
             # message contains a link; go to the link instead
@@ -1186,7 +1632,7 @@ class Interface(object):
             return
 
         path = cursor[0]
-        row_iter = self.grid_store.get_iter(path)
+        row_iter = self.shown_store.get_iter(path)
 
         popup_menu = gtk.Menu()
         popup_menu.set_screen(self.window.get_screen())
@@ -1194,7 +1640,7 @@ class Interface(object):
         # An open submenu with various choices underneath
         open_menu_items = []
 
-        tweet = self.grid_store.get_value(row_iter, Columns.ALL_DATA)
+        tweet = self.shown_store.get_value(row_iter, Columns.ALL_DATA)
 
         urls = url_re.findall(tweet['text'])
         for url in urls:
@@ -1219,8 +1665,8 @@ class Interface(object):
                 open_menu_items.append(item)
 
         item = gtk.MenuItem('This tweet')
-        username = self.grid_store.get_value(row_iter, Columns.USERNAME)
-        tweet_id = self.grid_store.get_value(row_iter, Columns.ID)
+        username = self.shown_store.get_value(row_iter, Columns.USERNAME)
+        tweet_id = self.shown_store.get_value(row_iter, Columns.ID)
         url = 'http://twitter.com/%s/statuses/%s/' % (username, tweet_id)
         item.connect('activate', self.open_url, url)
         open_menu_items.append(item)
@@ -1291,10 +1737,80 @@ class Interface(object):
         self.statusbar.push(self.statusbar_context,
                 'Updating list of tweets...')
 
-        self.twitter.friends_timeline(self.post_refresh, notify=notify)
+        if self.refresh_request:
+            # the new request supersedes the old one, if it's still there
+            self.refresh_request.cancel()
+        self.refresh_request = self.twitter.friends_timeline(
+                self.post_refresh, stream=self.stream_status, notify=notify)
 
         return True     # required by gobject.timeout_add
 
+    def check_backfill(self, adjustment):
+        """Called when the list scrolls or changes size; if we are close to
+        the bottom, ask for the tweets older than the last one in the
+        list."""
+
+        if self.backfill_end or not len(self.grid_store):
+            return
+
+        if self.shown_store is not self.grid_store:
+            # filtered list; the bottom is not the end of the timeline
+            return
+
+        if len(self.grid_store) >= MAX_STATUS_DISPLAY:
+            # they would be pruned anyway
+            return
+
+        bottom = adjustment.upper - adjustment.page_size
+        if bottom - adjustment.value > adjustment.page_size * BACKFILL_PAGES:
+            return
+
+        timeline = self.grid_store.timeline
+        oldest = timeline.id_at(len(timeline) - 1)
+
+        # the Twitter object ignores the repeated requests and keeps the
+        # number of them running at the same time small
+        self.twitter.backfill('friends_timeline', self.post_backfill,
+                max_id=oldest)
+        return
+
+    def post_backfill(self, data, error):
+        """Function called when the older tweets arrive. They go to the end
+        of the list, without notifications or scrolling."""
+
+        if error:
+            self.log.debug('Error %s requesting older tweets' % (error))
+            return
+
+        if not data:
+            self.log.debug('No older tweets')
+            self.backfill_end = True
+            return
+
+        if self.store:
+            self.store.add(data)
+
+        gtk.gdk.threads_enter()
+        pics = []
+        for tweet in data:
+            # the store ignores the ones it already has
+            if self.grid_store.add(tweet):
+                pics.append(tweet['user']['profile_image_url'])
+        self.schedule_times()
+        gtk.gdk.threads_leave()
+
+        self.log.debug('%d older tweets added' % (len(pics)))
+        for pic in pics:
+            self.queue_pic(pic)
+        return
+
+    def stream_status(self, status):
+        """Called for each status while the list of new tweets arrives; the
+        pics can start downloading before we have the whole list. This runs
+        in the network thread, so the pic is queued in the main loop."""
+        gobject.idle_add(self.queue_pic_once, status.user.profile_image_url)
+        return
+
     def post_refresh(self, data, error, notify):
         """Function called when the system retrieves the list of new
         tweets."""
@@ -1323,25 +1839,22 @@ class Interface(object):
             gtk.gdk.threads_leave()
             return
 
-        known_tweets = [row[Columns.ID] for row in self.grid_store]
         need_notify = False
         new_tweets = 0
         new_tweets_list = []
+        new_ids = set()
 
         for tweet in data:
-            id = tweet['id']
-            if str(id) in known_tweets:
+            id = int(tweet['id'])
+            if self.grid_store.has_status(id) or id in new_ids:
                 self.log.debug('Tweet %s is already in the list' % (id))
                 continue
+            new_ids.add(id)
 
-            created_at = tweet['created_at']
-            display_name = tweet['user']['name']
             username = tweet['user']['screen_name']
             user_pic = tweet['user']['profile_image_url']
-            message = tweet['text']
 
-            new_tweets_list.append((user_pic, display_name, message, username,
-                id, created_at, tweet))
+            new_tweets_list.append(tweet)
             self.queue_pic(user_pic)
 
             self.log.debug('New tweet with id %s from %s' % (id, username))
@@ -1350,17 +1863,22 @@ class Interface(object):
                 # but from everyone else it is fine.
                 new_tweets += 1
 
+        if self.store:
+            self.store.add(new_tweets_list)
+
         # add the new tweets in the store
         gtk.gdk.threads_enter()
-        for data in new_tweets_list:
-            self.grid_store.append(data)
+        for tweet in new_tweets_list:
+            self.grid_store.add(tweet)
+        self.schedule_times()
 
         self.statusbar.pop(self.statusbar_context)
 
         # there is new stuff, so we move to the top
 
-        p = self.grid_store.get_path(self.grid_store.get_iter_first())
-        self.grid.scroll_to_cell(p)
+        if self.shown_store is self.grid_store:
+            p = self.grid_store.get_path(self.grid_store.get_iter_first())
+            self.grid.scroll_to_cell(p)
         self.show_last_update()
         self.log.debug('Tweets updated')
         gtk.gdk.threads_leave()
@@ -1376,10 +1894,44 @@ class Interface(object):
     # Helper functions
     # ------------------------------------------------------------
 
+    def load_store(self):
+        """Open the tweet store of the current user and fill the list with
+        the newest tweets in it; the next refresh only brings the ones
+        after those."""
+
+        if self.store:
+            self.store.close()
+        self.clear_list()
+
+        # what's stored can be searched too
+        self.index.clear()
+        self.store = open_store(self.twitter.username, index=self.index)
+
+        tweets = self.store.latest(STARTUP_TWEETS)
+        self.log.debug('%d tweets from the store' % (len(tweets)))
+        if not tweets:
+            return
+
+        for tweet in tweets:
+            self.grid_store.add(tweet)
+        self.schedule_times()
+        self.twitter.set_since_id('friends_timeline',
+                self.store.newest_id())
+
+        for tweet in tweets:
+            self.queue_pic(tweet['user']['profile_image_url'])
+        return
+
     def clear_list(self):
         """Clear the list, so we can add more items."""
 
         self.grid_store.clear()
+        self.backfill_end = False
+
+        if self.shown_store is not self.grid_store:
+            # the tweets found are from the old list
+            self.filter_text.set_text('')
+            self.filter_grid()
 
         return
 
@@ -1469,10 +2021,62 @@ class Interface(object):
         if pic in self.pic_queue:
             return
 
-        self.pic_queue.add(pic)
-        self.twitter.download(pic, self.post_pic_download, id=pic)
+        if self.avatars.fresh(pic):
+            # no request to cancel, but it's already on its way
+            self.pic_queue[pic] = None
+            self.pic_loader.put(pic)
+            return
+
+        # if we have an old copy of the pic, this will just check if it
+        # changed
+        self.pic_queue[pic] = self.twitter.download(pic,
+                self.post_pic_download, cache=self.avatars, id=pic)
         return
 
+    def queue_pic_once(self, pic):
+        """queue_pic() for gobject.idle_add()."""
+        gtk.gdk.threads_enter()
+        self.queue_pic(pic)
+        gtk.gdk.threads_leave()
+        return False    # so idle_add doesn't call us again
+
+    def decode_pic(self, pic, data):
+        """Called by the pic loader threads to convert the <data> of <pic>
+        to a pixbuf. If there is no data, the pic is read from the avatar
+        cache."""
+        cached = data is None
+        if cached:
+            data = self.avatars.load(pic)
+            if not data:
+                return None
+
+        try:
+            return self.load_pic(data)
+        except gobject.GError:
+            if cached:
+                self.log.debug('Invalid pic in the cache, removing it')
+                self.avatars.remove(pic)
+            return None
+
+    def load_pic(self, data):
+        """Convert the pic <data> to a pixbuf of the size we display."""
+        loader = gtk.gdk.PixbufLoader()
+        #must set size before write
+        loader.set_size(48,48)
+        loader.write(data)
+        loader.close()
+
+        user_pic = loader.get_pixbuf()
+        user_pic  = user_pic.scale_simple(48, 48, gtk.gdk.INTERP_BILINEAR)
+        return user_pic
+
+    def scale_pic(self, data):
+        """Return the pic <data> scaled and converted to PNG, to be stored in
+        the avatar cache."""
+        parts = []
+        self.load_pic(data).save_to_callback(parts.append, 'png')
+        return ''.join(parts)
+
     def post_pic_download(self, data, error, id):
         """Function called once we downloaded the user pic."""
 
@@ -1480,24 +2084,36 @@ class Interface(object):
 
         if error or not data:
             self.log.debug('Error with the pic, not loading')
+            self.pic_queue.pop(id, None)
             return
 
-        loader = gtk.gdk.PixbufLoader()
-        #must set size before write
-        loader.set_size(48,48)
-        loader.write(data)
-        loader.close()
+        if self.avatars.fresh(id):
+            # the cache already has it scaled, which is faster to decode
+            data = None
+        self.pic_loader.put(id, data)
+        return
 
-        user_pic = loader.get_pixbuf()
-        user_pic  = user_pic.scale_simple(48, 48, gtk.gdk.INTERP_BILINEAR)
-        self.user_pics[id] = user_pic
-        self.pic_queue.discard(id)
+    def post_pic_load(self, pics):
+        """Called in the main loop with a list of (pic, pixbuf) decoded by
+        the pic loader. Only the rows with those pics are redrawn."""
 
-        # finally, request the grid to redraw itself
         gtk.gdk.threads_enter()
-        self.grid.queue_draw()
-        gtk.gdk.threads_leave()
 
+        loaded = set()
+        for (pic, pixbuf) in pics:
+            self.pic_queue.pop(pic, None)
+            if pixbuf is not None:
+                self.user_pics[pic] = pixbuf
+                loaded.add(pic)
+
+        self.log.debug('Loaded %d pics' % (len(loaded)))
+        if loaded:
+            for (path, iter) in self.visible_rows():
+                pic = self.shown_store.get_value(iter, Columns.PIC)
+                if pic in loaded:
+                    self.shown_store.row_changed(path, iter)
+
+        gtk.gdk.threads_leave()
         return
 
     # ------------------------------------------------------------
@@ -1509,9 +2125,14 @@ class Interface(object):
         every interface."""
 
         self.window.show_all()
+
+        # load the pics we already have while the first requests go on
+        self.avatars.prewarm(self.pic_loader.put)
+
         if not self.twitter.username or not self.twitter.password:
             self.settings_window.show()
         else:
+            self.load_store()
             self.refresh(None, False)   # do not notify if there are new tweets
             self.update_friends_list()
 
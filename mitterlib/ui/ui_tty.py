@@ -24,6 +24,8 @@ import mitterlib.ui.console_utils as console_utils
 import mitterlib
 import logging
 
+from mitterlib.store import open_store
+
 from optparse import OptionGroup
 
 
@@ -83,6 +85,10 @@ class Interface(object):
                 'last_reply': int(prefs.get('last_reply', 0)),
                 'last_id': int(prefs.get('last_id', 0))}
 
+        # no need to download again what we already displayed
+        self.twitter.set_since_id('friends_timeline', self.prefs['last_id'])
+        self.twitter.set_since_id('replies', self.prefs['last_reply'])
+
     def friends_timeline(self):
         """Starts the friends-timeline request."""
         self.twitter.friends_timeline(self._list_tweets)
@@ -104,6 +110,12 @@ class Interface(object):
             print 'Sorry, couldn\'t download your friends timeline.'
             return
 
+        if watch_field == 'last_id':
+            # keep them for the other interfaces
+            store = open_store(self.username)
+            store.add(data)
+            store.close()
+
         tweets = console_utils.print_tweets(data, self.prefs[watch_field])
         if tweets:
             self.prefs[watch_field] = tweets[-1]
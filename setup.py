@@ -27,6 +27,7 @@ params = {
             'License :: OSI Approved :: GNU General Public License (GPL)',
             'Operating System :: OS Independent',
             'Programming Language :: Python',
+            'Programming Language :: Python :: 2.7',
             'Topic :: Communications :: Chat']}
 
 from distutils.core import setup
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Mitter, a client for Twitter.
+# Copyright (C) 2007, 2008 The Mitter Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Micro-benchmark of the conversion of the dates sent by Twitter
+# (mitterlib.twitter._to_datetime), against the way it was done before
+# (splitting the date and searching the month in a list). Run it from the
+# top of the source tree: python tools/bench_dates.py
+
+import sys
+import os.path
+import datetime
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+
+from mitterlib import twitter
+
+
+def old_to_datetime(server_str):
+    """The conversion as it was before."""
+    month_names = [None, 'Jan', 'Feb','Mar','Apr','May','Jun','Jul',
+            'Aug','Sep','Oct','Nov','Dec']
+    date_info = server_str.split(' ')
+    month = month_names.index(date_info[1])
+    day = int(date_info[2])
+    year = int(date_info[5])
+
+    time_info = date_info[3].split(':')
+    hour = int(time_info[0])
+    minute = int(time_info[1])
+    second = int(time_info[2])
+
+    return datetime.datetime(year, month, day, hour, minute, second)
+
+
+def server_date(seconds):
+    """Return the date <seconds> after June 1st, 2008, like the server sends
+    it."""
+    date = datetime.datetime(2008, 6, 1) + \
+            datetime.timedelta(seconds=seconds)
+    return date.strftime('%a %b %d %H:%M:%S +0000 %Y')
+
+
+def convert_all(function, corpus):
+    """Convert all the dates in <corpus> with <function>."""
+    for date in corpus:
+        function(date)
+    return
+
+
+def main():
+    # 10k tweets with different dates...
+    unique = [server_date(random.randint(0, 30 * 24 * 60 * 60)) for _ in
+            xrange(10000)]
+
+    # ... and 10k tweets in pages of 20, where each refresh brings 5 new
+    # tweets (like replies, or a refresh without since_id)
+    dates = [server_date(second * 60) for second in xrange(2515)]
+    pages = []
+    for page in xrange(500):
+        pages.extend(dates[page * 5:page * 5 + 20])
+
+    for (corpus_name, corpus) in (('unique', unique), ('pages', pages)):
+        for (name, function) in (('old', old_to_datetime),
+                ('new', twitter._to_datetime)):
+            # each run starts with nothing cached
+            took = min(timeit.Timer(lambda: convert_all(function, corpus),
+                twitter._datetimes.clear).repeat(5, 1))
+            print '%-6s %-3s: %6.1fms' % (corpus_name, name, took * 1000)
+    return
+
+
+if __name__ == '__main__':
+    main()